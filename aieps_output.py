@@ -5,25 +5,114 @@ Mainly written by Andras Prim github_at_primandras.hu
 Arc to bezier converting method is ported from:
 http://code.google.com/p/core-framework/source/browse/trunk/plugins/svg.js
 written by Angel Kostadinov, with MIT license
-"""
 
-try:
-	from lxml import etree as ET
-except Exception:
-	import xml.etree.ElementTree as ET
+Besides the command line use (see main()), the module can be used as a
+library. Importing it has no side effects, and heavy modules (xml parser,
+numpy, multiprocessing) are imported on first use:
+
+    import aieps_output
+    aieps_output.convertFile('drawing.svg', open('drawing.eps', 'w'))
+    eps = aieps_output.convertBytes(svgData)
+
+For options, configure an svg2eps instance and pass it as converter.
+"""
 
 import re
 import math
+import sys
+import itertools
+import threading
+from array import array
+from collections import OrderedDict
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+ET = None # xml parser module, set by loadEtree()
+
+def loadEtree():
+    """imports lxml on first use, or the standard ElementTree if lxml is not available"""
+    global ET
+    if None == ET:
+        try:
+            from lxml import etree
+        except Exception:
+            import xml.etree.ElementTree as etree
+        ET = etree
+    return ET
+
+numpyModule = None # set by loadNumpy()
+
+def loadNumpy():
+    """imports numpy on first use, returns None if it is not available"""
+    global numpyModule
+    if None == numpyModule:
+        try:
+            import numpy
+            numpyModule = numpy
+        except ImportError:
+            numpyModule = False
+    return numpyModule or None
+
+class lineWrapper:
+    """streaming word-wrap that preserves existing line breaks
+
+    Text is fed in arbitrary chunks with write(), words are separated by
+    spaces. Only the current column is tracked, so wrapping is linear in the
+    length of the text. Output is written to out, which must have a write() method.
+    close() must be called after the last chunk."""
+    def __init__(self, out, width):
+        self.out = out
+        self.width = width
+        self.column = 0
+        self.pending = '' # last, possibly incomplete word of the previous chunk
+
+    def write(self, text):
+        words = text.split(' ')
+        words[0] = self.pending + words[0]
+        self.pending = words.pop()
+        self.out.write(self.wrapWords(words))
+
+    def wrapWords(self, words):
+        """returns the wrapped text of words, updates the current column"""
+        width = self.width
+        column = self.column
+        chunks = []
+        append = chunks.append
+        for word in words:
+            newline = word.find('\n')
+            if newline < 0:
+                wordLen = len(word)
+                if column + wordLen >= width:
+                    append(' \n')
+                    column = wordLen
+                else:
+                    append(' ')
+                    column += 1 + wordLen
+            else:
+                if column + newline >= width:
+                    append(' \n')
+                else:
+                    append(' ')
+                column = len(word) - word.rfind('\n') - 1
+            append(word)
+        self.column = column
+        return ''.join(chunks)
+
+    def close(self):
+        self.out.write(self.wrapWords([self.pending]))
+        self.pending = ''
+        self.column = 0
 
 def wrap(text, width):
     """ A word-wrap function that preserves existing line breaks """
-    retstr = ""
-    for word in text.split(' '):
-        if len(retstr)-retstr.rfind('\n')-1 + len(word.split('\n',1)[0]) >= width:
-            retstr += ' \n' + word
-        else:
-            retstr += ' ' + word
-    return retstr
+    out = StringIO()
+    wrapper = lineWrapper(out, width)
+    wrapper.write(text)
+    wrapper.close()
+    return out.getvalue()
 
 def css2dict(css):
     """returns a dictionary representing the given css string"""
@@ -36,14 +125,241 @@ def css2dict(css):
             cssdict[ key.strip() ] = value.strip()
     return cssdict
 
-def cssColor2Eps(cssColor, colors='RGB'):
-    """converts css color definition (a hexa code with leading #)
-    to eps color definition"""
-    r = float(int(cssColor[1:3],16)) / 255
-    g = float(int(cssColor[3:5],16)) / 255
-    b = float(int(cssColor[5:7],16)) / 255
+class lruCache:
+    """bounded mapping that drops the least recently used entry when full.
+    It can be shared between threads."""
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxSize:
+                self.data.popitem(last=False)
+
+class cssStyle(dict):
+    """a computed (inherited) css style. Instances are shared between elements,
+    so they must not be modified. serial identifies the instance in cache keys."""
+    serial = 0
+
+class styleResolver:
+    """parses style attributes and computes inherited styles with caching
+
+    Parsed style strings are kept in an LRU cache. Computed styles are
+    interned per (parent style, style attribute) pair, and an element that
+    does not change anything shares its parent's style instead of a copy."""
+    def __init__(self, maxSize=4096):
+        self.parsed = lruCache(maxSize)
+        self.computed = lruCache(maxSize)
+        self.serials = itertools.count(1) # next() is atomic, so serials stay unique across threads
+        self.root = self.newStyle({})
+
+    def newStyle(self, items):
+        style = cssStyle(items)
+        style.serial = next(self.serials)
+        return style
+
+    def parse(self, css):
+        """returns css2dict(css) from the cache. The result must not be modified."""
+        cssdict = self.parsed.get(css)
+        if None == cssdict:
+            cssdict = css2dict(css)
+            self.parsed.set(css, cssdict)
+        return cssdict
+
+    def compute(self, parent, css):
+        """returns the style of an element with style attribute css,
+        whose parent has the computed style parent"""
+        if not css:
+            return parent
+        key = (parent.serial, css)
+        style = self.computed.get(key)
+        if None == style:
+            own = self.parse(css)
+            for name, value in own.items():
+                if parent.get(name) != value:
+                    style = self.newStyle(parent)
+                    style.update(own)
+                    break
+            else:
+                style = parent
+            self.computed.set(key, style)
+        return style
+
+class numberFormat:
+    """formats numbers for the eps output with a fixed number of decimals.
+    In compact mode trailing zeros, the trailing decimal point and the sign
+    of negative zero are dropped (12.500000 -> 12.5, -0.000000 -> 0)."""
+    reTrailingZeros = re.compile(r'(\.[0-9]*[1-9])0+\b')
+    reZeroFraction = re.compile(r'\.0+\b')
+    reNegativeZero = re.compile(r'(?<![^ ])-0(?![^ ])')
+
+    def __init__(self, decimals=6, compact=False):
+        self.decimals = decimals
+        self.compact = compact
+        self.spec = '%%.%df' % (decimals,)
+        if compact:
+            # numbers are formatted by numbers(), and filled into %s
+            self.pointSpec = ' %s %s'
+        else:
+            self.pointSpec = ' %s %s' % (self.spec, self.spec)
+
+    def number(self, value):
+        """returns value formatted"""
+        return self.numbers((value,))
+
+    def numbers(self, values):
+        """returns values formatted and separated by spaces. Formatting and
+        compacting is done in bulk, not value by value."""
+        text = ' '.join([self.spec] * len(values)) % tuple(values)
+        if self.compact:
+            text = self.reTrailingZeros.sub(r'\1', text)
+            text = self.reZeroFraction.sub('', text)
+            text = self.reNegativeZero.sub('0', text)
+        return text
+
+def decimalsForTolerance(tolerance):
+    """returns the number of decimals needed, so that rounding error is at most
+    tolerance. Raises ValueError if tolerance is not positive."""
+    if not tolerance > 0:
+        raise ValueError("tolerance must be positive: %r" % (tolerance,))
+    return max(0, int(math.ceil(-math.log10(2 * tolerance))))
+
+defaultNumberFormat = numberFormat()
+
+# css named colors, as name and hexa code pairs
+cssColorNames = dict(zip(*[iter("""
+aliceblue f0f8ff antiquewhite faebd7 aqua 00ffff aquamarine 7fffd4 azure f0ffff
+beige f5f5dc bisque ffe4c4 black 000000 blanchedalmond ffebcd blue 0000ff
+blueviolet 8a2be2 brown a52a2a burlywood deb887 cadetblue 5f9ea0 chartreuse 7fff00
+chocolate d2691e coral ff7f50 cornflowerblue 6495ed cornsilk fff8dc crimson dc143c
+cyan 00ffff darkblue 00008b darkcyan 008b8b darkgoldenrod b8860b darkgray a9a9a9
+darkgreen 006400 darkgrey a9a9a9 darkkhaki bdb76b darkmagenta 8b008b
+darkolivegreen 556b2f darkorange ff8c00 darkorchid 9932cc darkred 8b0000
+darksalmon e9967a darkseagreen 8fbc8f darkslateblue 483d8b darkslategray 2f4f4f
+darkslategrey 2f4f4f darkturquoise 00ced1 darkviolet 9400d3 deeppink ff1493
+deepskyblue 00bfff dimgray 696969 dimgrey 696969 dodgerblue 1e90ff firebrick b22222
+floralwhite fffaf0 forestgreen 228b22 fuchsia ff00ff gainsboro dcdcdc
+ghostwhite f8f8ff gold ffd700 goldenrod daa520 gray 808080 green 008000
+greenyellow adff2f grey 808080 honeydew f0fff0 hotpink ff69b4 indianred cd5c5c
+indigo 4b0082 ivory fffff0 khaki f0e68c lavender e6e6fa lavenderblush fff0f5
+lawngreen 7cfc00 lemonchiffon fffacd lightblue add8e6 lightcoral f08080
+lightcyan e0ffff lightgoldenrodyellow fafad2 lightgray d3d3d3 lightgreen 90ee90
+lightgrey d3d3d3 lightpink ffb6c1 lightsalmon ffa07a lightseagreen 20b2aa
+lightskyblue 87cefa lightslategray 778899 lightslategrey 778899
+lightsteelblue b0c4de lightyellow ffffe0 lime 00ff00 limegreen 32cd32 linen faf0e6
+magenta ff00ff maroon 800000 mediumaquamarine 66cdaa mediumblue 0000cd
+mediumorchid ba55d3 mediumpurple 9370db mediumseagreen 3cb371
+mediumslateblue 7b68ee mediumspringgreen 00fa9a mediumturquoise 48d1cc
+mediumvioletred c71585 midnightblue 191970 mintcream f5fffa mistyrose ffe4e1
+moccasin ffe4b5 navajowhite ffdead navy 000080 oldlace fdf5e6 olive 808000
+olivedrab 6b8e23 orange ffa500 orangered ff4500 orchid da70d6 palegoldenrod eee8aa
+palegreen 98fb98 paleturquoise afeeee palevioletred db7093 papayawhip ffefd5
+peachpuff ffdab9 peru cd853f pink ffc0cb plum dda0dd powderblue b0e0e6
+purple 800080 rebeccapurple 663399 red ff0000 rosybrown bc8f8f royalblue 4169e1
+saddlebrown 8b4513 salmon fa8072 sandybrown f4a460 seagreen 2e8b57 seashell fff5ee
+sienna a0522d silver c0c0c0 skyblue 87ceeb slateblue 6a5acd slategray 708090
+slategrey 708090 snow fffafa springgreen 00ff7f steelblue 4682b4 tan d2b48c
+teal 008080 thistle d8bfd8 tomato ff6347 turquoise 40e0d0 violet ee82ee
+wheat f5deb3 white ffffff whitesmoke f5f5f5 yellow ffff00 yellowgreen 9acd32
+""".split())] * 2))
+
+reColorFunction = re.compile(r'(rgba?|hsla?)\(([^)]*)\)$')
+reColorArgSplit = re.compile(r'[\s,/]+')
+
+def colorArg(arg, scale):
+    """converts an rgb() or hsl() argument (a number, or a percentage of scale)
+    to a number between 0 and 1"""
+    if arg.endswith('%'):
+        return min(max(float(arg[:-1]) / 100, 0.0), 1.0)
+    return min(max(float(arg) / scale, 0.0), 1.0)
+
+def hue2rgb(p, q, t):
+    """helper of parseCssColor() for hsl colors"""
+    t = t % 1.0
+    if t < 1.0/6:
+        return p + (q - p) * 6 * t
+    if t < 0.5:
+        return q
+    if t < 2.0/3:
+        return p + (q - p) * (2.0/3 - t) * 6
+    return p
+
+def isPaint(cssPaint):
+    """tells if the fill or stroke value cssPaint paints anything"""
+    return cssPaint.strip().lower() not in ('none', 'transparent')
+
+def parseCssColor(cssColor):
+    """returns the (r, g, b) components (between 0 and 1) of a css color:
+    #rgb, #rrggbb (with optional alpha, which is ignored), rgb(), rgba(),
+    hsl(), hsla() or a named color. Returns None for unsupported values."""
+    cssColor = cssColor.strip().lower()
+    if cssColor in cssColorNames:
+        cssColor = '#' + cssColorNames[cssColor]
+    try:
+        if '#' == cssColor[0:1]:
+            hexa = cssColor[1:]
+            if len(hexa) in (3, 4):
+                return tuple(float(int(digit * 2, 16)) / 255 for digit in hexa[0:3])
+            if len(hexa) in (6, 8):
+                return (float(int(hexa[0:2],16)) / 255,
+                    float(int(hexa[2:4],16)) / 255,
+                    float(int(hexa[4:6],16)) / 255)
+            return None
+        match = reColorFunction.match(cssColor)
+        if None == match:
+            return None
+        args = reColorArgSplit.split(match.group(2).strip())
+        if len(args) < 3:
+            return None
+        if 'rgb' == match.group(1)[0:3]:
+            return tuple(colorArg(arg, 255.0) for arg in args[0:3])
+        hue = float(args[0].rstrip('deg')) / 360
+        saturation = colorArg(args[1], 100.0)
+        lightness = colorArg(args[2], 100.0)
+        if lightness < 0.5:
+            q = lightness * (1 + saturation)
+        else:
+            q = lightness + saturation - lightness * saturation
+        p = 2 * lightness - q
+        return (hue2rgb(p, q, hue + 1.0/3), hue2rgb(p, q, hue), hue2rgb(p, q, hue - 1.0/3))
+    except ValueError:
+        return None
+
+colorCache = lruCache(4096) # (css color, color model, decimals, compact) -> eps color
+
+def cssColor2Eps(cssColor, colors='RGB', fmt=defaultNumberFormat):
+    """converts css color definition (see parseCssColor()) to eps color
+    definition in the colors color model ('RGB' or 'CMYKRGB'), formatted with
+    numberFormat fmt. Returns None if the color is not supported.
+    Results are cached, because documents use the same few colors many times."""
+    key = (cssColor, colors, fmt.decimals, fmt.compact)
+    epsColor = colorCache.get(key)
+    if None == epsColor:
+        epsColor = epsColorOf(parseCssColor(cssColor), colors, fmt)
+        colorCache.set(key, epsColor or '')
+    return epsColor or None
+
+def epsColorOf(rgb, colors, fmt):
+    """formats the rgb color components (between 0 and 1) as eps color
+    definition in the colors color model"""
+    if None == rgb:
+        return None
+    r, g, b = rgb
     if colors == 'RGB':
-        return "%f %f %f" % (r, g, b)
+        return fmt.numbers((r, g, b))
     elif colors == 'CMYKRGB':
         if (r == 0) and (g == 0) and (b == 0):
             c = 0
@@ -62,22 +378,751 @@ def cssColor2Eps(cssColor, colors='RGB'):
             y = (y - min_cmy) / (1 - min_cmy)
             k = min_cmy
 
-        return "%f %f %f %f %f %f %f" % (c, m, y, k, r, g, b)
+        return fmt.numbers((c, m, y, k, r, g, b))
+
+class graphicsState:
+    """tracks the operands of paint style operators (like XA, Xa, w, d) that
+    are in effect in the written eps, so that unchanged values need not be
+    written again. Unknown values are simply missing."""
+    def __init__(self):
+        self.values = {}
+        self.saved = []
+
+    def change(self, op, operands):
+        """records that op is set to operands. Returns False if it is already
+        set to that, so the operator need not be written."""
+        if self.values.get(op) == operands:
+            return False
+        self.values[op] = operands
+        return True
+
+    def forget(self, op=None):
+        """makes the value of op (or of every operator) unknown"""
+        if None == op:
+            self.values = {}
+        else:
+            self.values.pop(op, None)
+
+    def push(self):
+        """should be called at the start of a clip group (q)"""
+        self.saved.append(dict(self.values))
+
+    def pop(self):
+        """should be called at the end of a clip group (Q). A value is known
+        afterwards only if it is the same inside and outside the group, because
+        a consumer may or may not restore the state at Q."""
+        saved = self.saved.pop()
+        self.values = dict((op, operands) for op, operands in saved.items() \
+            if self.values.get(op) == operands)
+
+class epsWriter:
+    """buffered sink for eps output: collects chunks in a list and passes them
+    to the underlying file-like object in large blocks"""
+    def __init__(self, out, bufferSize=65536):
+        self.out = out
+        self.bufferSize = bufferSize
+        self.chunks = []
+        self.size = 0
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.out.write(''.join(self.chunks))
+            self.chunks = []
+            self.size = 0
+
+# number of arguments of each svg path command
+pathArgCounts = {'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7, 'Z': 0}
+for cmd, argCount in list(pathArgCounts.items()):
+    pathArgCounts[cmd.lower()] = argCount
+# a path data token is a command letter, a number, or any other single character (a syntax error)
+rePathToken = re.compile(r'[A-Za-z]|[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?|[^ \t\r\n,]')
+
+# elements converted by elemPath()
+shapeTags = ('path', 'rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon')
+
+def parsePathData(pathData):
+    """yields (command, arguments) tuples from svg path data in a single pass.
+    Arguments are floats (arc flags are ints), implicit repeated commands are
+    yielded separately, coordinates after a moveto are yielded as lineto.
+    Compact forms like "1.5.5", "-1-2" and "a1 1 0 011 1" are handled.
+    Raises ValueError at the first syntax error, after the valid part is yielded."""
+    tokens = rePathToken.findall(pathData)
+    tokenNum = len(tokens)
+    i = 0
+    cmd = None
+    argCount = 0
+    while i < tokenNum:
+        token = tokens[i]
+        if token in pathArgCounts:
+            cmd = token
+            i += 1
+            argCount = pathArgCounts[cmd]
+            if 0 == argCount:
+                yield (cmd, ())
+                continue
+        elif 0 == argCount:
+            raise ValueError("invalid path data at token %d: %s" % (i, token))
+
+        if 'A' == cmd or 'a' == cmd:
+            # flags are single characters, and may be written without separator
+            # (like "011 1") so they are split off from the following number
+            args = []
+            for j in range(7):
+                if i >= tokenNum:
+                    raise ValueError("missing path data arguments after token %d" % (i,))
+                token = tokens[i]
+                if 3 == j or 4 == j:
+                    if token[0] not in '01':
+                        raise ValueError("invalid arc flag at token %d: %s" % (i, token))
+                    args.append(int(token[0]))
+                    if len(token) > 1:
+                        tokens[i] = token[1:]
+                    else:
+                        i += 1
+                else:
+                    args.append(float(token))
+                    i += 1
+            args = tuple(args)
+        else:
+            if i + argCount > tokenNum:
+                raise ValueError("missing path data arguments after token %d" % (i,))
+            # float() raises ValueError for letters and invalid characters
+            args = tuple(map(float, tokens[i:i+argCount]))
+            i += argCount
+        yield (cmd, args)
+
+        if 'M' == cmd:
+            cmd = 'L'
+        elif 'm' == cmd:
+            cmd = 'l'
+
+reTransformFind = re.compile('([a-zA-Z]+)\\(([^)]+)\\)')
+reNumberFind = re.compile('[0-9.eE+-]+')
+# must update reNumberUnitFind, if e is a valid character in a unit
+reNumberUnitFind = re.compile('([0-9.eE+-]+)([a-z]*)')
+reReferenceFind = re.compile(r'url\(#([^)]+)\)')
+
+# affine matrices (a, b, c, d, e, f) are immutable tuples, so they can be
+# shared by the matrix stack and the caches without copying
+identityMatrix = (1, 0, 0, 1, 0, 0)
+transformCache = lruCache(4096) # transform attribute -> parseTransform() result
+
+def composeMatrix(matrix, matrix2):
+    """returns the product of matrix and matrix2 (matrix2 is applied first).
+    Identity, translation and scaling are multiplied with fewer terms."""
+    a2, b2, c2, d2, e2, f2 = matrix2
+    if 0 == b2 and 0 == c2:
+        a, b, c, d, e, f = matrix
+        if 1 == a2 and 1 == d2:
+            if 0 == e2 and 0 == f2:
+                return matrix
+            return (a, b, c, d, a*e2 + c*f2 + e, b*e2 + d*f2 + f)
+        if 0 == e2 and 0 == f2:
+            return (a*a2, b*a2, c*d2, d*d2, e, f)
+    if identityMatrix == matrix:
+        return matrix2
+    a, b, c, d, e, f = matrix
+    return (a*a2 + c*b2, b*a2 + d*b2,
+        a*c2 + c*d2, b*c2 + d*d2,
+        a*e2 + c*f2 + e, b*e2 + d*f2 + f)
+
+def parseTransform(transform):
+    """returns (matrix, alerts) of an svg transform attribute, where alerts
+    are the strings of the unsupported parts. Results are cached, documents
+    repeat the same few transforms a lot."""
+    result = transformCache.get(transform)
+    if None != result:
+        return result
+    matrix = identityMatrix
+    alerts = []
+    for ttype, targs in reTransformFind.findall(transform):
+        targs = [float(x) for x in reNumberFind.findall(targs)]
+        if ttype == 'matrix':
+            matrix = composeMatrix(matrix, tuple(targs[0:6]))
+        elif ttype == 'translate':
+            tx = targs[0]
+            ty = targs[1] if len(targs) > 1 else 0
+            matrix = composeMatrix(matrix, (1, 0, 0, 1, tx, ty))
+        elif ttype == 'scale':
+            sx = targs[0]
+            sy = targs[1] if len(targs) > 1 else sx
+            matrix = composeMatrix(matrix, (sx, 0, 0, sy, 0, 0))
+        elif ttype == 'rotate':
+            alpha = math.radians(targs[0])
+            rotation = (math.cos(alpha), math.sin(alpha), -math.sin(alpha), math.cos(alpha), 0, 0)
+            if len(targs) == 1:
+                matrix = composeMatrix(matrix, rotation)
+            else:
+                matrix = composeMatrix(matrix, (1, 0, 0, 1, targs[1], targs[2]))
+                matrix = composeMatrix(matrix, rotation)
+                matrix = composeMatrix(matrix, (1, 0, 0, 1, -targs[1], -targs[2]))
+        elif ttype == 'skewX' or ttype == 'skewY':
+            alerts.append("skewX and skewY transformations are not supported")
+        else:
+            alerts.append("unknown transform type: " + ttype)
+    result = (matrix, tuple(alerts))
+    transformCache.set(transform, result)
+    return result
+
+def indexIds(root):
+    """returns the id -> element dict of the tree under root"""
+    idIndex = {}
+    for elem in root.iter():
+        elemId = elem.get('id')
+        if None != elemId and elemId not in idIndex:
+            idIndex[elemId] = elem
+    return idIndex
+
+def isLayer(elem):
+    """tells if elem is an inkscape layer"""
+    return 'layer' == elem.get('{http://www.inkscape.org/namespaces/inkscape}groupmode') \
+        and 'g' == str(elem.tag).split('}')[-1]
+
+def iterparseFile(svgPath):
+    """returns a start and end event iterator of the svg file at svgPath"""
+    etree = loadEtree()
+    if hasattr(etree, 'LXML_VERSION'):
+        # comments would pile up in the tree, as they have no end event
+        return etree.iterparse(svgPath, events=('start', 'end'), huge_tree=True,
+            remove_comments=True, remove_pis=True)
+    return etree.iterparse(svgPath, events=('start', 'end'))
+
+def parseSvg(svg):
+    """returns the root element of svg document data"""
+    etree = loadEtree()
+    if hasattr(etree, 'LXML_VERSION'):
+        # deep nesting and long text nodes are allowed, like in iterparseFile()
+        return etree.fromstring(svg, etree.XMLParser(huge_tree=True))
+    return etree.fromstring(svg)
+
+def collectReferences(elem, refs):
+    """adds the ids referenced by the attributes of elem to the set refs"""
+    href = elem.get('{http://www.w3.org/1999/xlink}href')
+    if None != href and '#' == href[0:1]:
+        refs.add(href[1:])
+    for name in ('clip-path', 'style'):
+        value = elem.get(name)
+        if None != value and 'url(' in value:
+            refs.update(reReferenceFind.findall(value))
+
+# elliptical arc to bezier conversion
+#
+# Arc to bezier converting method is ported from Angel Kostadinov's code (see
+# the module docstring). Arcs are split into segments of at most 90 degrees.
+# Axis aligned quarter arcs (corners of rounded rectangles and ellipses) take
+# a shortcut, general arcs rarely repeat their angles, so they are not cached.
+
+arcKappa = 4.0 / 3.0 * (math.sqrt(2) - 1) # control point distance of a unit quarter circle
+
+def unitArcTable(s1, segr, seg):
+    """returns (t, points): the control point distance factor of segments of
+    segr radians, and the (cos, sin) unit circle points at the seg + 1
+    segment ends starting at angle s1"""
+    t = 8.0/3.0 * math.sin(segr/4) * math.sin(segr/4) / math.sin(segr/2)
+    points = [ (math.cos(s1), math.sin(s1)) ]
+    for n in range(seg):
+        s1 += segr
+        points.append( (math.cos(s1), math.sin(s1)) )
+    return (t, points)
+
+def quarterArc(x0, y0, x1, y1, sweep):
+    """returns the bezier coordinates (x1, y1, x2, y2, x, y) of an axis aligned
+    quarter ellipse from (x0, y0) to (x1, y1). sweep is the svg sweep flag."""
+    dx = x1 - x0
+    dy = y1 - y0
+    # the corner of the bounding box, that is not on the arc
+    if (1 == sweep) == (dx * dy < 0):
+        kx, ky = x0, y1
+    else:
+        kx, ky = x1, y0
+    return (x0 + arcKappa * (kx - x0), y0 + arcKappa * (ky - y0),
+        x1 + arcKappa * (kx - x1), y1 + arcKappa * (ky - y1), x1, y1)
+
+def arcToBeziers(rx, ry, r1, r2, psai, largeArcFlag, fS, cx, cy):
+    """converts the svg arc from (rx, ry) to (cx, cy) with radii r1, r2 and
+    x axis rotation psai (degrees) to bezier curves. Returns their
+    coordinates (6 per curve), or None if the arc is a line."""
+    if r1 <= 0 or r2 <= 0:
+        return None
+    if rx == cx and ry == cy:
+        return [] # svg omits an arc to its start point
+    if 0 == psai and 0 == largeArcFlag:
+        # allow for rounding of the end point calculation, like x + rx - x
+        epsilon = 1e-9 * (abs(rx) + abs(ry) + r1 + r2)
+        if abs(abs(cx - rx) - r1) <= epsilon and abs(abs(cy - ry) - r2) <= epsilon:
+            return quarterArc(rx, ry, cx, cy, fS)
 
-class svg2eps:
-    def __init__(self, filename=None):
-        self.filename = filename
-        self.svg = None
-        self.rePathDSplit = re.compile('[^a-zA-Z0-9.-]+')
-        self.reTransformFind = re.compile('([a-z]+)\\(([^)]+)\\)')
-        self.reNumberFind = re.compile('[0-9.eE+-]+')
-        # must update reNumberUnitFind, if e is a valid character in a unit
-        self.reNumberUnitFind = re.compile('([0-9.eE+-]+)([a-z]*)')
+# Angel Kostadinov begin
+    ctx = (rx - cx) / 2
+    cty = (ry - cy) / 2
+    cpsi = math.cos(psai*math.pi/180)
+    spsi = math.sin(psai*math.pi/180)
+    rxd = cpsi*ctx + spsi*cty
+    ryd = -1*spsi*ctx + cpsi*cty
+    rxdd = rxd * rxd
+    rydd = ryd * ryd
+    r1x = r1 * r1
+    r2y = r2 * r2
+    lamda = rxdd/r1x + rydd/r2y
+
+    if lamda > 1:
+        r1 = math.sqrt(lamda) * r1
+        r2 = math.sqrt(lamda) * r2
+        sds = 0
+    else:
+        seif = 1
+        if largeArcFlag == fS:
+            seif = -1
+        sds = seif * math.sqrt((r1x*r2y - r1x*rydd - r2y*rxdd) / (r1x*rydd + r2y*rxdd))
+
+    txd = sds*r1*ryd / r2
+    tyd = -1 * sds*r2*rxd / r1
+    tx = cpsi*txd - spsi*tyd + (rx+cx)/2
+    ty = spsi*txd + cpsi*tyd + (ry+cy)/2
+    rad = math.atan2((ryd-tyd)/r2, (rxd-txd)/r1) - math.atan2(0, 1)
+    if rad >= 0:
+        s1 = rad
+    else:
+        s1 = 2 * math.pi + rad
+    rad = math.atan2((-ryd-tyd)/r2, (-rxd-txd)/r1) - math.atan2((ryd-tyd)/r2, (rxd-txd)/r1)
+    if rad >= 0:
+        dr = rad
+    else:
+        dr = 2 * math.pi + rad
+
+    if fS==0 and dr > 0:
+        dr -= 2*math.pi
+    elif fS==1 and dr < 0:
+        dr += 2*math.pi
+
+    sse = dr * 2 / math.pi
+    # a rounding error must not add a segment to a quarter (half, ...) arc
+    if sse < 0:
+        seg = max(1, math.ceil(-1*sse - 1e-9))
+    else:
+        seg = max(1, math.ceil(sse - 1e-9))
+    segr = dr / seg
+    t, points = unitArcTable(s1, segr, int(seg))
+    cpsir1 = cpsi * r1
+    cpsir2 = cpsi * r2
+    spsir1 = spsi * r1
+    spsir2 = spsi * r2
+    mc, ms = points[0]
+    x2 = rx - t * (cpsir1*ms + spsir2*mc)
+    y2 = ry - t * (spsir1*ms - cpsir2*mc)
+
+    coords = []
+    for mc, ms in points[1:]:
+        x3 = cpsir1*mc - spsir2*ms + tx
+        y3 = spsir1*mc + cpsir2*ms + ty
+        dx = -t * (cpsir1*ms + spsir2*mc)
+        dy = -t * (spsir1*ms - cpsir2*mc)
+
+        coords.extend( (x2, y2, x3-dx, y3-dy, x3, y3) )
+
+        x2 = x3 + dx
+        y2 = y3 + dy
+# Angel Kostadinov end
+    return coords
+
+pathMove = 0
+pathLine = 1
+pathCurve = 2
+
+class compactPath:
+    """intermediate representation of a path: the operators (pathMove,
+    pathLine, pathCurve) in ops, their svg coordinates in coords, and the
+    subpaths in segments, as [first op, end op, first coordinate, end
+    coordinate, closed, closing line] lists.
+    elemPath() builds it, then stray point removal and closing run on it,
+    before pathText() writes it in one pass."""
+    def __init__(self):
+        self.ops = array('B')
+        self.coords = array('d')
+        self.segments = []
+        self.curX = self.curY = 0.0 # current point
+        self.startX = self.startY = 0.0 # start of the current subpath
+
+    def moveTo(self, x, y):
+        if len(self.segments) > 0:
+            self.endSegment()
+        self.segments.append([len(self.ops), 0, len(self.coords), 0, False, False])
+        self.ops.append(pathMove)
+        self.coords.append(x)
+        self.coords.append(y)
+        self.curX = self.startX = x
+        self.curY = self.startY = y
+
+    def startDrawing(self):
+        """starts a subpath at the current point, if there is no open one
+        (drawing after closepath starts a new subpath)"""
+        if len(self.segments) == 0 or self.segments[-1][4]:
+            self.moveTo(self.curX, self.curY)
+
+    def lineTo(self, x, y):
+        self.startDrawing()
+        self.ops.append(pathLine)
+        self.coords.append(x)
+        self.coords.append(y)
+        self.curX = x
+        self.curY = y
+
+    def curveTo(self, x1, y1, x2, y2, x, y):
+        self.startDrawing()
+        self.ops.append(pathCurve)
+        self.coords.extend( (x1, y1, x2, y2, x, y) )
+        self.curX = x
+        self.curY = y
+
+    def close(self):
+        if len(self.segments) > 0:
+            self.segments[-1][4] = True
+        self.curX = self.startX
+        self.curY = self.startY
+
+    def endSegment(self):
+        segment = self.segments[-1]
+        segment[1] = len(self.ops)
+        segment[3] = len(self.coords)
+
+    def finish(self):
+        """must be called after the last operator"""
+        if len(self.segments) > 0:
+            self.endSegment()
+
+    def removeStrays(self):
+        """removes subpaths that are only a moveto, returns their number"""
+        count = len(self.segments)
+        self.segments = [segment for segment in self.segments if segment[1] - segment[0] > 1]
+        return count - len(self.segments)
+
+    def closeSegments(self, autoClose, closeDist):
+        """closes every subpath if autoClose is True. Closed subpaths get an
+        explicit closing line if their end is further than closeDist from
+        their start."""
+        coords = self.coords
+        for segment in self.segments:
+            if segment[4] or autoClose:
+                segment[4] = True
+                coordStart = segment[2]
+                coordEnd = segment[3]
+                segment[5] = abs(coords[coordEnd-2] - coords[coordStart]) + \
+                    abs(coords[coordEnd-1] - coords[coordStart+1]) > closeDist
+
+    def layout(self):
+        """returns (ops, coords, subpaths) of the remaining subpaths, with
+        their closing lines. subpaths are (first op, end op, first coordinate,
+        closed) tuples."""
+        if self.isContiguous():
+            return (self.ops, self.coords,
+                [(segment[0], segment[1], segment[2], segment[4]) for segment in self.segments])
+        ops = array('B')
+        coords = array('d')
+        subpaths = []
+        for opStart, opEnd, coordStart, coordEnd, closed, closeLine in self.segments:
+            subpathStart = len(ops)
+            subpathCoord = len(coords)
+            ops.extend(self.ops[opStart:opEnd])
+            coords.extend(self.coords[coordStart:coordEnd])
+            if closeLine:
+                ops.append(pathLine)
+                coords.extend(self.coords[coordStart:coordStart + 2])
+            subpaths.append( (subpathStart, len(ops), subpathCoord, closed) )
+        return (ops, coords, subpaths)
+
+    def isContiguous(self):
+        """tells if the subpaths cover coords without gaps or closing lines"""
+        coordEnd = 0
+        for segment in self.segments:
+            if segment[2] != coordEnd or segment[5]:
+                return False
+            coordEnd = segment[3]
+        return coordEnd == len(self.coords)
+
+def simplifyPath(ops, coords, subpaths, tolerance, numpyMinPoints=None):
+    """simplifies a path within tolerance: curves that are flat within
+    tolerance become lines, and runs of lines are thinned with the
+    Ramer-Douglas-Peucker algorithm. Returns new (ops, coords, subpaths),
+    see compactPath.layout(). numpy is used for runs of at least
+    numpyMinPoints points (None: never)."""
+    newOps = array('B')
+    newCoords = []
+    newSubpaths = []
+    for opStart, opEnd, coordStart, closed in subpaths:
+        subpathStart = len(newOps)
+        subpathCoord = len(newCoords)
+        # the points of the current run of lines, starting with its anchor
+        xs = []
+        ys = []
+        j = coordStart
+        for op in ops[opStart:opEnd]:
+            if pathMove == op:
+                newOps.append(pathMove)
+                newCoords.extend( (coords[j], coords[j+1]) )
+                xs = [coords[j]]
+                ys = [coords[j+1]]
+                j += 2
+                continue
+            if pathCurve == op:
+                x0, y0 = xs[-1], ys[-1]
+                x3, y3 = coords[j+4], coords[j+5]
+                if segmentDistance(coords[j], coords[j+1], x0, y0, x3, y3) > tolerance or \
+                        segmentDistance(coords[j+2], coords[j+3], x0, y0, x3, y3) > tolerance:
+                    flushLineRun(xs, ys, tolerance, numpyMinPoints, newOps, newCoords)
+                    newOps.append(pathCurve)
+                    newCoords.extend(coords[j:j+6])
+                    xs = [x3]
+                    ys = [y3]
+                    j += 6
+                    continue
+                j += 4 # flat curve: line to its end point
+            xs.append(coords[j])
+            ys.append(coords[j+1])
+            j += 2
+        flushLineRun(xs, ys, tolerance, numpyMinPoints, newOps, newCoords)
+        newSubpaths.append( (subpathStart, len(newOps), subpathCoord, closed) )
+    return (newOps, newCoords, newSubpaths)
+
+def flushLineRun(xs, ys, tolerance, numpyMinPoints, ops, coords):
+    """appends the lines of a run (xs[0], ys[0] is where the run starts)
+    that are kept by the Ramer-Douglas-Peucker simplification"""
+    keep = rdpKeep(xs, ys, tolerance, numpyMinPoints)
+    for i in range(1, len(xs)):
+        if keep[i]:
+            ops.append(pathLine)
+            coords.append(xs[i])
+            coords.append(ys[i])
+
+def segmentDistance(x, y, x1, y1, x2, y2):
+    """returns the distance of point x, y from the segment x1, y1 - x2, y2"""
+    dx = x2 - x1
+    dy = y2 - y1
+    lengthSquare = dx*dx + dy*dy
+    if 0 == lengthSquare:
+        return math.hypot(x - x1, y - y1)
+    t = ((x - x1) * dx + (y - y1) * dy) / lengthSquare
+    t = min(max(t, 0.0), 1.0)
+    return math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+def rdpKeep(xs, ys, tolerance, numpyMinPoints=None):
+    """returns a list of flags telling which points of the polyline are kept
+    by the Ramer-Douglas-Peucker simplification. The first and last points
+    are always kept. Ranges of at least numpyMinPoints points are measured
+    with numpy, if it is available."""
+    count = len(xs)
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    if count < 3:
+        return keep
+    np = None
+    if None != numpyMinPoints and count >= numpyMinPoints:
+        np = loadNumpy()
+    if None != np:
+        xa = np.array(xs)
+        ya = np.array(ys)
+    stack = [ (0, count - 1) ]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        x1, y1, x2, y2 = xs[first], ys[first], xs[last], ys[last]
+        if None != np and last - first >= numpyMinPoints:
+            # distance from the segment, like segmentDistance()
+            px = xa[first+1:last] - x1
+            py = ya[first+1:last] - y1
+            dx = x2 - x1
+            dy = y2 - y1
+            lengthSquare = dx*dx + dy*dy
+            if 0 == lengthSquare:
+                distances = np.hypot(px, py)
+            else:
+                t = np.clip((px * dx + py * dy) / lengthSquare, 0.0, 1.0)
+                distances = np.hypot(px - t * dx, py - t * dy)
+            index = int(np.argmax(distances))
+            maxDistance = float(distances[index])
+            index += first + 1
+        else:
+            maxDistance = -1.0
+            for i in range(first + 1, last):
+                distance = segmentDistance(xs[i], ys[i], x1, y1, x2, y2)
+                if distance > maxDistance:
+                    maxDistance = distance
+                    index = i
+        if maxDistance > tolerance:
+            keep[index] = True
+            stack.append( (first, index) )
+            stack.append( (index, last) )
+    return keep
+
+def cubicRange(p0, p1, p2, p3):
+    """returns the (min, max) of one coordinate of a cubic bezier curve"""
+    low = min(p0, p3)
+    high = max(p0, p3)
+    # roots of the derivative divided by 3: a t^2 + b t + c
+    a = -p0 + 3*p1 - 3*p2 + p3
+    b = 2 * (p0 - 2*p1 + p2)
+    c = p1 - p0
+    if abs(a) < 1e-12:
+        roots = [-c / b] if abs(b) > 1e-12 else []
+    else:
+        discriminant = b*b - 4*a*c
+        if discriminant < 0:
+            roots = []
+        else:
+            sqrtD = math.sqrt(discriminant)
+            roots = [(-b + sqrtD) / (2*a), (-b - sqrtD) / (2*a)]
+    for t in roots:
+        if 0 < t < 1:
+            mt = 1 - t
+            value = mt*mt*mt*p0 + 3*mt*mt*t*p1 + 3*mt*t*t*p2 + t*t*t*p3
+            low = min(low, value)
+            high = max(high, value)
+    return (low, high)
+
+def pathBounds(ops, coords):
+    """returns the exact bounding box [minx, miny, maxx, maxy] of the path
+    given by ops (pathMove, pathLine, pathCurve) and flat coords, or None if
+    it is empty"""
+    if len(ops) == 0:
+        return None
+    minx = miny = float('inf')
+    maxx = maxy = float('-inf')
+    curves = [] # coordinate index of the first control point of curves
+    j = 0
+    for op in ops:
+        if pathCurve == op:
+            curves.append(j)
+            j += 4
+        x = coords[j]
+        y = coords[j+1]
+        if x < minx: minx = x
+        if x > maxx: maxx = x
+        if y < miny: miny = y
+        if y > maxy: maxy = y
+        j += 2
+    # a curve is inside the box of its end points, if its control points are
+    for j in curves:
+        x1, y1, x2, y2 = coords[j], coords[j+1], coords[j+2], coords[j+3]
+        if min(x1, x2) < minx or max(x1, x2) > maxx:
+            low, high = cubicRange(coords[j-2], x1, x2, coords[j+4])
+            minx = min(minx, low)
+            maxx = max(maxx, high)
+        if min(y1, y2) < miny or max(y1, y2) > maxy:
+            low, high = cubicRange(coords[j-1], y1, y2, coords[j+5])
+            miny = min(miny, low)
+            maxy = max(maxy, high)
+    return [minx, miny, maxx, maxy]
+
+def miterRatio(ops, coords, subpaths, limit):
+    """returns the largest miter length / stroke width ratio of the miter
+    joins of the path (1 if all of them are beveled by the miter limit).
+    subpaths are (first op, end op, first coordinate, closed) tuples."""
+    ratio = 1.0
+    for opStart, opEnd, coordStart, closed in subpaths:
+        # points with a flag telling if it is on the curve (a join)
+        points = []
+        j = coordStart
+        for op in ops[opStart:opEnd]:
+            if pathCurve == op:
+                points.append( (coords[j], coords[j+1], False) )
+                points.append( (coords[j+2], coords[j+3], False) )
+                j += 4
+            points.append( (coords[j], coords[j+1], True) )
+            j += 2
+        count = len(points)
+        for i in range(count):
+            x, y, onCurve = points[i]
+            if not onCurve or (not closed and (0 == i or count - 1 == i)):
+                continue
+            # tangents: the nearest different points before and after
+            before = after = None
+            for k in range(1, count):
+                if i - k < 0 and not closed:
+                    break
+                px, py, flag = points[(i - k) % count]
+                if px != x or py != y:
+                    before = (x - px, y - py)
+                    break
+            for k in range(1, count):
+                if i + k >= count and not closed:
+                    break
+                px, py, flag = points[(i + k) % count]
+                if px != x or py != y:
+                    after = (px - x, py - y)
+                    break
+            if None == before or None == after:
+                continue
+            cosine = (before[0]*after[0] + before[1]*after[1]) / \
+                (math.hypot(before[0], before[1]) * math.hypot(after[0], after[1]))
+            # miter length / width = 1 / sin(join angle / 2)
+            if cosine > -1 + 1e-12:
+                joinRatio = math.sqrt(2 / (1 + cosine))
+                if joinRatio <= limit:
+                    ratio = max(ratio, joinRatio)
+    return ratio
+
+def addBox(box, other):
+    """returns the union of two bounding boxes, any of them can be None"""
+    if None == box:
+        return other
+    if None == other:
+        return box
+    return [min(box[0], other[0]), min(box[1], other[1]),
+        max(box[2], other[2]), max(box[3], other[3])]
+
+def transformBox(box, matrix):
+    """returns the bounding box of box transformed by matrix"""
+    if None == box:
+        return None
+    a, b, c, d, e, f = matrix
+    xs = []
+    ys = []
+    for x, y in ((box[0], box[1]), (box[2], box[1]), (box[0], box[3]), (box[2], box[3])):
+        xs.append(a*x + c*y + e)
+        ys.append(b*x + d*y + f)
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+class conversionContext:
+    """state of one conversion run by svg2eps.convert(). The converter holds
+    only configuration and shared caches, everything that changes during a
+    conversion is here, so one converter can run conversions concurrently."""
+    def __init__(self, converter):
+        self.bodyMemSize = converter.bodyMemSize
+        self.useNumpy = converter.useNumpy
+        self.numpyMinPoints = converter.numpyMinPoints
+        self.useProcedures = converter.useProcedures
+        self.autoClose = converter.autoClose
+        self.removeInvisible = converter.removeInvisible
+        self.removeStrayPoints = converter.removeStrayPoints
+        self.closeDist = converter.closeDist
+        self.layerJobs = converter.layerJobs
+        self.tightBoundingBox = converter.tightBoundingBox
+        self.simplifyTolerance = converter.simplifyTolerance
+        self.statistics = {'removedPoints': {}} # path id -> number of points removed by simplification
+        self.converter = converter
+        # cached layers can not share procedures, see startLayerPool(), and
+        # the layers are only partly parsed at their start in streaming mode
+        if None != converter.cacheDir and converter.useCache and not converter.useProcedures \
+                and not converter.streaming:
+            self.layerCache = fragmentCache(converter.cacheDir, converter.cacheMaxSize)
+        else:
+            self.layerCache = None
+        self.fmt = numberFormat(converter.decimals, converter.compactNumbers)
+        self.styles = converter.styles
         # px to pt conversion rate varies based on inkscape versions, it is added during parsing
-        self.toPt = {'in': 72.0, 'pt': 1.0, 'mm': 2.8346456695, 'cm': 28.346456695, 'm': 2834.6456695, 'pc': 12.0}
+        self.toPt = dict(converter.toPt)
+        self.alerts = {}
 
     def unitConv(self, string, toUnit):
-        match = self.reNumberUnitFind.search(string)
+        match = reNumberUnitFind.search(string)
+        if None == match:
+            raise ValueError("invalid length: " + string)
         number = float(match.group(1))
         unit = match.group(2)
         if unit not in self.toPt:
@@ -88,6 +1133,23 @@ class svg2eps:
         else:
             return number * self.toPt[unit] / self.toPt[toUnit]
 
+    def lengthAttrs(self, elem, names, default=0.0):
+        """returns the values of the length attributes names of elem in user
+        units (default for missing ones), or None after an alert if one of
+        them is invalid"""
+        lengths = []
+        for name in names:
+            value = elem.get(name)
+            if None == value:
+                lengths.append(default)
+                continue
+            try:
+                lengths.append(self.unitConv(value, 'uu'))
+            except ValueError:
+                self.alert("invalid length, shape is ignored: " + name, elem)
+                return None
+        return lengths
+
     def lengthConv(self, svgLength):
         """converts svgLength to eps length using the current transformation matrix"""
         matrix = self.matrices[-1]
@@ -96,31 +1158,16 @@ class svg2eps:
 
         return math.sqrt(epsx*epsx + epsy*epsy)
 
-    def coordConv(self, svgx, svgy, relative=False):
+    def coordConv(self, svgx, svgy):
         """converts svgx, svgy coordinates to eps coordinates using the current transformation matrix"""
-        if relative:
-            svgx = float(svgx) + self.curPoint[0]
-            svgy = float(svgy) + self.curPoint[1]
-        else:
-            svgx = float(svgx)
-            svgy = float(svgy)
+        svgx = float(svgx)
+        svgy = float(svgy)
         matrix = self.matrices[-1]
         epsx = matrix[0] * svgx + matrix[2] * svgy + matrix[4]
         epsy = matrix[1] * svgx + matrix[3] * svgy + matrix[5]
 
         return (epsx, epsy)
 
-    def matrixMul(self, matrix, matrix2):
-        """multiplies matrix with matrix2"""
-        matrix0 = matrix[:]
-        matrix[0] = matrix0[0] * matrix2[0] + matrix0[2]*matrix2[1] # + matrix0[4]*0
-        matrix[1] = matrix0[1] * matrix2[0] + matrix0[3]*matrix2[1] # + matrix0[5]*0
-        matrix[2] = matrix0[0] * matrix2[2] + matrix0[2]*matrix2[3] # + matrix0[4]*0
-        matrix[3] = matrix0[1] * matrix2[2] + matrix0[3]*matrix2[3] # + matrix0[5]*0
-        matrix[4] = matrix0[0] * matrix2[4] + matrix0[2]*matrix2[5] + matrix0[4]
-        matrix[5] = matrix0[1] * matrix2[4] + matrix0[3]*matrix2[5] + matrix0[5]
-
-
     def alert(self, string, elem):
         """adds an alert to the collection"""
         if not string in self.alerts:
@@ -129,12 +1176,6 @@ class svg2eps:
         if elemId != None:
             self.alerts[string].add(elemId)
 
-    def showAlerts(self):
-        """show alerts collected by the alert() function"""
-        for string, ids in self.alerts.iteritems():
-            idstring = ', '.join(ids)
-            print(string, idstring)
-
     def elemSvg(self, elem):
         """handles the <svg> element"""
         # DPI changed in inkscape 0.92, so set the px-to-pt rate based on inkscape version
@@ -162,25 +1203,25 @@ class svg2eps:
 
         # transform svg units to eps default pt
         scale = self.toPt['uu']
-        self.matrices = [ [scale, 0, 0, -scale, 0, self.docHeight] ]
+        self.matrices = [ (scale, 0, 0, -scale, 0, self.docHeight) ]
 
 
     def gradientFill(self, elem, gradientId):
         """constructs a gradient instance definition in self.gradientOp"""
-        if gradientId not in self.gradients:
+        transformGradient = self.gradientById(gradientId)
+        if None == transformGradient:
             self.alert("fill gradient not defined: "+gradientId, elem )
             return
+        gradientId, error = self.resolveGradient(gradientId)
+        if None != error:
+            self.alert(error, elem)
+            return
         gradient = self.gradients[gradientId]
-        transformGradient = gradient
-        while 'href' in gradient:
-            gradientId = gradient['href']
-            gradient = self.gradients[gradientId]
         if 'matrix' in transformGradient:
-            self.matrices.append( self.matrices[-1][:] )
-            self.matrixMul(self.matrices[-1],transformGradient['matrix'])
+            self.matrices.append( composeMatrix(self.matrices[-1], transformGradient['matrix']) )
 
         if 'linear' == transformGradient['type']:
-            gradient['linUseCount'] += 1
+            name = self.gradientName('l_', gradient)
             x1, y1 = self.coordConv(transformGradient['x1'], transformGradient['y1'])
             x2, y2 = self.coordConv(transformGradient['x2'], transformGradient['y2'])
             deltax = x2 - x1
@@ -189,7 +1230,7 @@ class svg2eps:
             angle = math.atan2(deltay, deltax)*180/math.pi
 
         elif 'radial' == transformGradient['type']:
-            gradient['radUseCount'] += 1
+            name = self.gradientName('r_', gradient)
             cx, cy = self.coordConv(transformGradient['cx'], transformGradient['cy'])
             # fx, fy = self.coordConv(transformGradient['fx'], transformGradient['fy'])
             rx, ry = self.coordConv(transformGradient['cx'] + transformGradient['r'], transformGradient['cy'])
@@ -200,16 +1241,60 @@ class svg2eps:
 
 
         if 'linear' == transformGradient['type']:
-            #endPathSegment() will substitute appropriate closeOp in %%s
-            self.gradientOp = "\nBb 1 (l_%s) %f %f %f %f 1 0 0 1 0 0 Bg %%s 0 BB" % \
-                (gradientId, x1, y1, angle, length)
+            #pathText() will substitute appropriate closeOp in %%s
+            self.gradientOp = "\nBb 1 (%s) %s 1 0 0 1 0 0 Bg %%s 0 BB" % \
+                (name, self.fmt.numbers((x1, y1, angle, length)))
         elif 'radial' == transformGradient['type']:
-            self.gradientOp = "\nBb 1 (r_%s) %f %f 0 %f 1 0 0 1 0 0 Bg %%s 0 BB" % \
-                (gradientId, cx, cy, r)
+            self.gradientOp = "\nBb 1 (%s) %s 0 %s 1 0 0 1 0 0 Bg %%s 0 BB" % \
+                (name, self.fmt.numbers((cx, cy)), self.fmt.number(r))
             self.alert("radial gradients will appear circle shaped", elem)
 
 
 
+    def resolveGradient(self, gradientId):
+        """follows the href chain of a gradient to the gradient that has the
+        stops. Returns (its id, None) or (None, alert string). The result is
+        kept for the other uses of the gradient."""
+        if gradientId in self.gradientChains:
+            return self.gradientChains[gradientId]
+        chain = [gradientId]
+        gradient = self.gradients[gradientId]
+        result = None
+        while 'href' in gradient:
+            hrefId = gradient['href']
+            if hrefId in self.gradientChains:
+                result = self.gradientChains[hrefId]
+                break
+            if hrefId in chain:
+                result = (None, "circular reference ignored: #" + hrefId)
+                break
+            gradient = self.gradientById(hrefId)
+            if None == gradient:
+                result = (None, "gradient href not found: " + hrefId)
+                break
+            chain.append(hrefId)
+        if None == result:
+            result = (chain[-1], None)
+        for chainId in chain:
+            self.gradientChains[chainId] = result
+        return result
+
+    def gradientName(self, prefix, gradient):
+        """returns the name of the gradient definition with the stops of
+        gradient: gradients of the same kind with identical stops share one
+        definition (see gradientSetup()). The name is a hash of the kind and
+        the stops, so it does not depend on other gradients of the document,
+        and layer workers and cached layers use the same names."""
+        stops = tuple(gradient['stops'])
+        key = (prefix, stops)
+        name = self.gradientNames.get(key)
+        if None == name:
+            import hashlib
+            content = prefix + ' '.join(['%r %s' % (offset, color) for offset, color in stops])
+            name = prefix + hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+            self.gradientNames[key] = name
+        return name
+
     def pathStyle(self, elem):
         """handles the style attribute in svg element"""
         if self.clipPath:
@@ -217,414 +1302,374 @@ class svg2eps:
             return
 
         css = self.cssStack[-1]
-        if 'stroke' in css and css['stroke'] != 'none':
+        if 'stroke' in css and isPaint(css['stroke']):
             self.closeOp = 's'
-            self.pathCloseOp = 's'
-            if '#' == css['stroke'][0]:
-                self.epspath += ' ' + cssColor2Eps(css['stroke']) + ' XA'
-            elif 'url' == css['stroke'][0:3]:
+            if 'url' == css['stroke'][0:3]:
                 self.alert("gradient strokes not supported", elem)
-        if 'fill' in css and css['fill'] != 'none':
+            else:
+                self.colorOp(elem, 'XA', css['stroke'])
+        if 'fill' in css and isPaint(css['fill']):
             if self.closeOp == 's':
                 self.closeOp = 'b'
             else:
                 self.closeOp = 'f'
-            if '#' == css['fill'][0]:
-                self.epspath += ' ' + cssColor2Eps(css['fill']) + ' Xa'
-            elif 'url' == css['fill'][0:3]:
+            if 'url' != css['fill'][0:3]:
+                self.colorOp(elem, 'Xa', css['fill'])
+            else:
                 self.gradientFill(elem, css['fill'][5:-1])
+                # gradient fill replaces the current fill color
+                self.gstate.forget('Xa')
 
 
+        # fill rule is not tracked: m resets it in the non-Illustrator prolog
         if 'fill-rule' in css:
             if css['fill-rule'] == 'evenodd':
-                self.epspath += " 1 XR"
+                self.epspath.append(" 1 XR")
             else:
-                self.epspath += " 0 XR"
+                self.epspath.append(" 0 XR")
         if 'stroke-width' in css:
-            self.epspath += " %f w" % (self.lengthConv(self.unitConv(css['stroke-width'], 'uu')), )
+            self.styleOp('w', self.fmt.number(self.lengthConv(self.unitConv(css['stroke-width'], 'uu'))))
         if 'stroke-linecap' in css:
             if css['stroke-linecap'] == 'butt':
-                self.epspath += " 0 J"
+                self.styleOp('J', '0')
             elif css['stroke-linecap'] == 'round':
-                self.epspath += " 1 J"
+                self.styleOp('J', '1')
             elif css['stroke-linecap'] == 'square':
-                self.epspath += " 2 J"
+                self.styleOp('J', '2')
         if 'stroke-linejoin' in css:
             if css['stroke-linejoin'] == 'miter':
-                self.epspath += " 0 j"
+                self.styleOp('j', '0')
             elif css['stroke-linejoin'] == 'round':
-                self.epspath += " 1 j"
+                self.styleOp('j', '1')
             elif css['stroke-linejoin'] == 'bevel':
-                self.epspath += " 2 j"
+                self.styleOp('j', '2')
         if 'stroke-miterlimit' in css:
-            self.epspath += " " + css['stroke-miterlimit'] + " M"
+            self.styleOp('M', css['stroke-miterlimit'])
         if 'stroke-dasharray' in css:
             phase = 0
             if css['stroke-dasharray'] == 'none':
-                dashArray = []
+                dashArray = ''
             else:
-                dashArray = list(map(lambda x: "%f" % (self.lengthConv(float(x)),), css['stroke-dasharray'].split(',')))
+                dashArray = self.fmt.numbers([self.lengthConv(float(x)) for x in css['stroke-dasharray'].split(',')])
                 if 'stroke-dashoffset' in css:
                     phase = float(css['stroke-dashoffset'])
 
-            self.epspath += ' [ %s ] %f d' % (' '.join(dashArray), phase)
-
-
-
-    def endPathSegment(self, elem):
-        """should be called when a path segment end is reached in a <path> element"""
-        if self.removeStrayPoints and self.segmentCommands <= 1:
-            self.alert("removing stray point", elem)
-            self.epspath = self.epspath[:self.segmentStartIndex]
-            return
-        if self.autoClose and (self.closeOp == 'f' or self.closeOp == 'b'):
-            autoClose = True
-        else:
-            autoClose = False
-
-        if self.pathExplicitClose or autoClose:
-            closeOp = self.closeOp
-        else:
-            closeOp = self.closeOp.upper()
-
-        if self.pathCurSegment == self.pathSegmentNum and self.gradientOp != None:
-            closeOp = self.gradientOp % (closeOp,)
-
-        if self.lastBegin != None:
-            if (self.pathExplicitClose or autoClose):
-                if abs(self.curPoint[0] - self.lastBegin[0]) + \
-                    abs(self.curPoint[1] - self.lastBegin[1]) > self.closeDist:
-                    x, y = self.coordConv(self.lastBegin[0], self.lastBegin[1])
-                    self.epspath += ' %f %f l' % (x, y)
-
-            self.epspath += ' ' + closeOp + '\n'
-
-            if self.pathExplicitClose:
-                self.curPoint = self.lastBegin
-
-        self.lastBegin = None
-
-    def elemPath(self, elem, pathData=None):
-        """handles <path> svg element"""
+            self.styleOp('d', '[ %s ] %s' % (dashArray, self.fmt.number(phase)))
+
+    def colorOp(self, elem, op, cssColor):
+        """appends a color operator (XA or Xa) for cssColor to the current path"""
+        if 'currentcolor' == cssColor.lower():
+            cssColor = self.cssStack[-1].get('color', 'black')
+        epsColor = cssColor2Eps(cssColor, 'RGB', self.fmt)
+        if None == epsColor:
+            # black, like elemStop(), the painting operator must not use the
+            # color of a previous path
+            self.alert("unsupported color: " + cssColor, elem)
+            epsColor = cssColor2Eps('black', 'RGB', self.fmt)
+        self.styleOp(op, epsColor)
+
+    def styleOp(self, op, operands):
+        """appends a paint style operator to the current path, unless the
+        graphics state already has the same operands for it"""
+        if self.gstate.change(op, operands):
+            self.epspath.append(' ' + operands + ' ' + op)
+
+
+    def elemPath(self, elem, pathData=None, commands=None):
+        """handles <path> svg element. Other shapes pass their outline as
+        pathData, or as commands: (command, arguments) pairs like the ones
+        of parsePathData()"""
         if None == pathData:
             pathData = elem.get('d')
-        self.pathSegmentNum = pathData.count("m") + pathData.count("M")
-        self.pathCurSegment = 0
-        self.epspath = ''
-        self.segmentStartIndex = 0 # index in self.epspath of first character of current path segment
-        self.segmentCommands = 0 # number of handled commands (including first moveto) in current paths segment
+        # literal eps chunks written before the path: note and style operators
+        self.epspath = []
         self.closeOp = 'n' # pathStyle(elem) will modify this
         self.gradientOp = None
-        self.pathExplicitClose = False
-        self.epspath += '\n%AI3_Note: ' + elem.get('id') + '\n'
+        elemId = elem.get('id')
+        if None != elemId:
+            self.epspath.append('\n%AI3_Note: ' + elemId + '\n')
+        else:
+            self.epspath.append('\n')
         self.pathStyle(elem)
 
-        tokens = self.rePathDSplit.split(pathData)
-        i = 0
-        cmd = '' # path command
-        self.curPoint = (0,0)
-        self.lastBegin = None
-
-        while i < len(tokens):
-            token = tokens[i]
-            if token in ['m', 'M', 'c', 'C', 'l', 'L', 'z', 'Z', 'a', 'A', 'q', 'Q', 'h', 'H', 'v', 'V']:
-                cmd = token
-                i += 1
-            elif token.isalpha():
-                self.alert('unhandled path command: %s' % (token,), elem)
-                cmd = ''
-                i += 1
-            else: # coordinates after a moveto are assumed to be lineto
-                if 'm' == cmd:
-                    cmd = 'l'
-                elif 'M' == cmd:
-                    cmd = 'L'
-
-            if ('M' == cmd or 'm' == cmd) :
-                if self.pathCurSegment > 0:
-                    self.endPathSegment(elem)
-                self.pathCurSegment += 1
-                self.pathExplicitClose = False
-
-            if 'M' == cmd or 'm' == cmd:
-                if 'M' == cmd or ('m' == cmd and i == 1):
-                    self.curPoint = (float(tokens[i]), float(tokens[i+1]))
-                else:
-                    self.curPoint = (self.curPoint[0] + float(tokens[i]), self.curPoint[1] + float(tokens[i+1]))
-
-                self.segmentStartIndex = len(self.epspath)
-                x, y = self.coordConv(self.curPoint[0], self.curPoint[1])
-                self.epspath += ' %f %f' % (x, y)
-                i += 2
-                self.lastBegin = self.curPoint
-                self.epspath += ' m'
-                self.segmentCommands = 1
-            elif 'L' == cmd or 'l' == cmd:
-                if 'L' == cmd:
-                    self.curPoint = (float(tokens[i]), float(tokens[i+1]))
-                else:
-                    self.curPoint = (self.curPoint[0] + float(tokens[i]), self.curPoint[1] + float(tokens[i+1]))
-                x, y = self.coordConv(self.curPoint[0], self.curPoint[1])
-                self.epspath += ' %f %f' % (x, y)
-                i += 2
-                self.epspath += ' l'
-                self.segmentCommands += 1
-            elif cmd in ['H', 'h', 'V', 'v']:
-                if 'H' == cmd:
-                    self.curPoint = (float(tokens[i]), self.curPoint[1])
-                elif 'h' == cmd:
-                    self.curPoint = (self.curPoint[0] + float(tokens[i]), self.curPoint[1])
-                elif 'V' == cmd:
-                    self.curPoint = (self.curPoint[0], float(tokens[i]))
-                elif 'v' == cmd:
-                    self.curPoint = (self.curPoint[0], self.curPoint[1] + float(tokens[i]))
-                x, y = self.coordConv(self.curPoint[0], self.curPoint[1])
-                self.epspath += ' %f %f' % (x, y)
-                i += 1
-                self.epspath += ' l'
-                self.segmentCommands += 1
-            elif 'C' == cmd:
-                for j in range(2):
-                    x, y = self.coordConv(tokens[i], tokens[i+1])
-                    self.epspath += ' %f %f' % (x, y)
-                    i += 2
-                self.curPoint = (float(tokens[i]), float(tokens[i+1]))
-                x, y = self.coordConv(self.curPoint[0], self.curPoint[1])
-                self.epspath += ' %f %f' % (x, y)
-                i += 2
-                self.epspath += ' c'
-                self.segmentCommands += 1
-            elif 'c' == cmd:
-                for j in range(2):
-                    x, y = self.coordConv(self.curPoint[0] + float(tokens[i]), self.curPoint[1] +float(tokens[i+1]))
-                    self.epspath += ' %f %f' % (x, y)
-                    i += 2
-                self.curPoint = (self.curPoint[0] + float(tokens[i]), self.curPoint[1] + float(tokens[i+1]))
-                x, y = self.coordConv(self.curPoint[0], self.curPoint[1])
-                self.epspath += ' %f %f' % (x, y)
-                i += 2
-                self.epspath += ' c'
-                self.segmentCommands += 1
-            elif 'Q' == cmd:
-                #export quadratic Bezier as cubic
-                x, y = self.coordConv(tokens[i], tokens[i+1])
-                self.epspath += ' %f %f %f %f' % (x, y, x, y)
-                i += 2
-                self.curPoint = (float(tokens[i]), float(tokens[i+1]))
-                x, y = self.coordConv(self.curPoint[0], self.curPoint[1])
-                self.epspath += ' %f %f' % (x, y)
-                i += 2
-                self.epspath += ' c'
-                self.segmentCommands += 1
-            elif 'q' == cmd:
-                x, y = self.coordConv(self.curPoint[0] + float(tokens[i]), self.curPoint[1] +float(tokens[i+1]))
-                self.epspath += ' %f %f %f %f' % (x, y, x, y)
-                i += 2
-                self.curPoint = (self.curPoint[0] + float(tokens[i]), self.curPoint[1] + float(tokens[i+1]))
-                x, y = self.coordConv(self.curPoint[0], self.curPoint[1])
-                self.epspath += ' %f %f' % (x, y)
-                i += 2
-                self.epspath += ' c'
-                self.segmentCommands += 1
-            elif 'A' == cmd or 'a' == cmd:
-                self.alert("elliptic arcs are converted to bezier curves", elem)
-
-# Angel Kostadinov begin
-                r1 = abs(float(tokens[i]))
-                r2 = abs(float(tokens[i+1]))
-                psai = float(tokens[i+2])
-                largeArcFlag = int(tokens[i + 3])
-                fS = int(tokens[i+4])
-                rx = self.curPoint[0]
-                ry = self.curPoint[1]
-                if 'A' == cmd:
-                    cx, cy = (float(tokens[i+5]), float(tokens[i+6]))
-                else:
-                    cx, cy = (self.curPoint[0] +float(tokens[i+5]), self.curPoint[1] +float(tokens[i+6]))
-
-                if r1 > 0 and r2 > 0:
-                    ctx = (rx - cx) / 2
-                    cty = (ry - cy) / 2
-                    cpsi = math.cos(psai*math.pi/180)
-                    spsi = math.sin(psai*math.pi/180)
-                    rxd = cpsi*ctx + spsi*cty
-                    ryd = -1*spsi*ctx + cpsi*cty
-                    rxdd = rxd * rxd
-                    rydd = ryd * ryd
-                    r1x = r1 * r1
-                    r2y = r2 * r2
-                    lamda = rxdd/r1x + rydd/r2y
-
-                    if lamda > 1:
-                        r1 = math.sqrt(lamda) * r1
-                        r2 = math.sqrt(lamda) * r2
-                        sds = 0
-                    else:
-                        seif = 1
-                        if largeArcFlag == fS:
-                            seif = -1
-                        sds = seif * math.sqrt((r1x*r2y - r1x*rydd - r2y*rxdd) / (r1x*rydd + r2y*rxdd))
-
-                    txd = sds*r1*ryd / r2
-                    tyd = -1 * sds*r2*rxd / r1
-                    tx = cpsi*txd - spsi*tyd + (rx+cx)/2
-                    ty = spsi*txd + cpsi*tyd + (ry+cy)/2
-                    rad = math.atan2((ryd-tyd)/r2, (rxd-txd)/r1) - math.atan2(0, 1)
-                    if rad >= 0:
-                        s1 = rad
-                    else:
-                        s1 = 2 * math.pi + rad
-                    rad = math.atan2((-ryd-tyd)/r2, (-rxd-txd)/r1) - math.atan2((ryd-tyd)/r2, (rxd-txd)/r1)
-                    if rad >= 0:
-                        dr = rad
-                    else:
-                        dr = 2 * math.pi + rad
-
-                    if fS==0 and dr > 0:
-                        dr -= 2*math.pi
-                    elif fS==1 and dr < 0:
-                        dr += 2*math.pi
-
-                    sse = dr * 2 / math.pi
-                    if sse < 0:
-                        seg = math.ceil(-1*sse)
-                    else:
-                        seg = math.ceil(sse)
-                    segr = dr / seg
-                    t = 8.0/3.0 * math.sin(segr/4) * math.sin(segr/4) / math.sin(segr/2)
-                    cpsir1 = cpsi * r1
-                    cpsir2 = cpsi * r2
-                    spsir1 = spsi * r1
-                    spsir2 = spsi * r2
-                    mc = math.cos(s1)
-                    ms = math.sin(s1)
-                    x2 = rx - t * (cpsir1*ms + spsir2*mc)
-                    y2 = ry - t * (spsir1*ms - cpsir2*mc)
-
-                    for n in range(int(math.ceil(seg))):
-                        s1 += segr
-                        mc = math.cos(s1)
-                        ms = math.sin(s1)
-
-                        x3 = cpsir1*mc - spsir2*ms + tx
-                        y3 = spsir1*mc + cpsir2*ms + ty
-                        dx = -t * (cpsir1*ms + spsir2*mc)
-                        dy = -t * (spsir1*ms - cpsir2*mc)
-
-                        cx1, cy1 = self.coordConv(x2,y2)
-                        cx2, cy2 = self.coordConv(x3-dx,y3-dy)
-                        cx3, cy3 = self.coordConv(x3,y3)
-
-                        self.epspath += " %f %f %f %f %f %f c" % (cx1, cy1, cx2, cy2, cx3, cy3)
-
-                        x2 = x3 + dx
-                        y2 = y3 + dy
-                else:
-                    # case when one radius is zero: this is a simple line
-                    x, y = self.coordConv(cx, cy)
-                    self.epspath += ' %f %f l' % (x, y)
-
-# Angel Kostadinov end
-                self.segmentCommands += 1
-                i += 7
-                self.curPoint= (cx, cy)
-
-            elif 'z' == cmd:
-                self.pathExplicitClose = True
-                cmd = ''
+        self.path = compactPath()
+        if None == commands:
+            commands = parsePathData(pathData)
+        try:
+            for cmd, args in commands:
+                self.pathCommand(elem, cmd, args)
+        except ValueError:
+            self.alert("invalid path data, rest of the path is ignored", elem)
+        self.path.finish()
+
+        compound = len(self.path.segments) > 1
+        if self.removeStrayPoints and self.path.removeStrays() > 0:
+            self.alert("removing stray point", elem)
+        autoClose = self.autoClose and (self.closeOp == 'f' or self.closeOp == 'b')
+        self.path.closeSegments(autoClose, self.closeDist)
+
+        if compound:
+            self.epspath.insert(0, " *u\n")
+        self.body.write("\n")
+        wrapper = lineWrapper(self.body, 70)
+        wrapper.write(self.pathText(elem))
+        if compound:
+            wrapper.write("\n*U ")
+        wrapper.close()
+        self.body.write("\n")
+
+    def pathText(self, elem):
+        """returns the eps text of the current path (without the closing *U
+        of compound paths). All coordinates are transformed at once, and
+        formatted by a single format operation."""
+        ops, svgCoords, subpaths = self.path.layout()
+        epsCoords = self.coordsConv(svgCoords)
+        if None != self.simplifyTolerance:
+            pointCount = len(epsCoords) // 2
+            numpyMinPoints = None
+            if self.useNumpy:
+                numpyMinPoints = self.numpyMinPoints
+            ops, epsCoords, subpaths = simplifyPath(ops, epsCoords, subpaths,
+                self.simplifyTolerance, numpyMinPoints)
+            removed = pointCount - len(epsCoords) // 2
+            if removed > 0:
+                self.alert("path simplified", elem)
+                removedPoints = self.statistics['removedPoints']
+                # shapes without id are counted together under None
+                removedPoints[elem.get('id')] = removedPoints.get(elem.get('id'), 0) + removed
+        if self.tightBoundingBox:
+            self.addPathBox(ops, epsCoords, subpaths)
+
+        pointSpec = self.fmt.pointSpec
+        opTemplates = (pointSpec + ' m', pointSpec + ' l', pointSpec * 3 + ' c')
+        template = [chunk.replace('%', '%%') for chunk in self.epspath]
+        for opStart, opEnd, coordStart, closed in subpaths:
+            template.extend([opTemplates[op] for op in ops[opStart:opEnd]])
+            if closed:
+                closeOp = self.closeOp
             else:
-                i += 1
-
-        self.endPathSegment(elem)
+                closeOp = self.closeOp.upper()
+            if opEnd == len(ops) and self.gradientOp != None:
+                closeOp = self.gradientOp % (closeOp,)
+            template.append(' ' + closeOp + '\n')
+
+        if self.fmt.compact and len(epsCoords) > 0:
+            epsCoords = self.fmt.numbers(epsCoords).split(' ')
+        return ''.join(template) % tuple(epsCoords)
+
+    def addPathBox(self, ops, epsCoords, subpaths):
+        """adds the bounding box of the current path (with its stroke) to the
+        bounding box of the document, see svg2eps.tightBoundingBox"""
+        if self.closeOp in ('n', 'N'):
+            return # not painted
+        box = pathBounds(ops, epsCoords)
+        if None == box:
+            return
+        if self.closeOp in ('s', 'b'):
+            # stroke parameters are in the graphics state (set by this or
+            # previous paths), PostScript defaults are used if unknown
+            values = self.gstate.values
+            halfWidth = float(values.get('w', 1)) / 2
+            pad = halfWidth
+            if '2' == values.get('J'): # square cap
+                pad = halfWidth * math.sqrt(2)
+            if '0' == values.get('j', '0'): # miter join
+                limit = float(values.get('M', 10))
+                pad = max(pad, halfWidth * miterRatio(ops, epsCoords, subpaths, limit))
+            box = [box[0] - pad, box[1] - pad, box[2] + pad, box[3] + pad]
+        self.addBox(box)
+
+    def addBox(self, box):
+        """adds box to the innermost bounding box being collected"""
+        self.boxes[-1] = addBox(self.boxes[-1], box)
+
+    def coordsConv(self, coords):
+        """converts a flat list of svg coordinates (x0, y0, x1, y1, ...) to eps
+        coordinates using the current transformation matrix. Long lists are
+        transformed with numpy, if it is available."""
+        a, b, c, d, e, f = self.matrices[-1]
+        if self.useNumpy and len(coords) >= 2 * self.numpyMinPoints:
+            np = loadNumpy()
+            if None != np:
+                points = np.array(coords, dtype=float)
+                # copies, the slices are views of points which is overwritten
+                svgx = points[0::2].copy()
+                svgy = points[1::2].copy()
+                points[0::2] = svgx * a + svgy * c + e
+                points[1::2] = svgx * b + svgy * d + f
+                return points.tolist()
+
+        epsCoords = []
+        append = epsCoords.append
+        coordIter = iter(coords)
+        for svgx, svgy in zip(coordIter, coordIter):
+            append(a * svgx + c * svgy + e)
+            append(b * svgx + d * svgy + f)
+        return epsCoords
+
+    def pathCommand(self, elem, cmd, args):
+        """handles one (command, arguments) pair of the path data in elemPath"""
+        path = self.path
+        if 'M' == cmd:
+            path.moveTo(args[0], args[1])
+        elif 'm' == cmd:
+            path.moveTo(path.curX + args[0], path.curY + args[1])
+        elif 'L' == cmd:
+            path.lineTo(args[0], args[1])
+        elif 'l' == cmd:
+            path.lineTo(path.curX + args[0], path.curY + args[1])
+        elif 'H' == cmd:
+            path.lineTo(args[0], path.curY)
+        elif 'h' == cmd:
+            path.lineTo(path.curX + args[0], path.curY)
+        elif 'V' == cmd:
+            path.lineTo(path.curX, args[0])
+        elif 'v' == cmd:
+            path.lineTo(path.curX, path.curY + args[0])
+        elif 'C' == cmd:
+            path.curveTo(*args)
+        elif 'c' == cmd:
+            cx = path.curX
+            cy = path.curY
+            path.curveTo(cx + args[0], cy + args[1], cx + args[2], cy + args[3], cx + args[4], cy + args[5])
+        elif 'Q' == cmd or 'q' == cmd:
+            #export quadratic Bezier as cubic
+            if 'q' == cmd:
+                cx = path.curX
+                cy = path.curY
+                args = (cx + args[0], cy + args[1], cx + args[2], cy + args[3])
+            path.curveTo(args[0], args[1], args[0], args[1], args[2], args[3])
+        elif 'A' == cmd or 'a' == cmd:
+            self.alert("elliptic arcs are converted to bezier curves", elem)
+
+            if 'A' == cmd:
+                cx, cy = (args[5], args[6])
+            else:
+                cx, cy = (path.curX + args[5], path.curY + args[6])
+            coords = arcToBeziers(path.curX, path.curY, abs(args[0]), abs(args[1]),
+                args[2], args[3], args[4], cx, cy)
+            if None == coords:
+                # case when one radius is zero: this is a simple line
+                path.lineTo(cx, cy)
+            else:
+                for i in range(0, len(coords), 6):
+                    path.curveTo(*coords[i:i+6])
 
-        if self.pathSegmentNum > 1:
-            self.epspath = " *u\n" + self.epspath + "\n*U "
-        self.epsLayers += "\n" + wrap(self.epspath, 70) + "\n"
+        elif 'z' == cmd or 'Z' == cmd:
+            path.close()
+        else:
+            self.alert('unhandled path command: %s' % (cmd,), elem)
 
     def elemRect(self, elem):
-        x = float(elem.get('x'))
-        y = float(elem.get('y'))
-        width = float(elem.get('width'))
-        height = float(elem.get('height'))
-
-        # construct an svg <path> d attribute, and call self.elemPath()
-        pathData = ""
-        rx = elem.get('rx')
-        ry = elem.get('ry')
+        lengths = self.lengthAttrs(elem, ('x', 'y', 'width', 'height'))
+        radii = self.lengthAttrs(elem, ('rx', 'ry'), None)
+        if None == lengths or None == radii:
+            return
+        x, y, width, height = lengths
+
+        # construct svg path commands, and call self.elemPath()
+        rx, ry = radii
         if None == rx and None == ry:
             rx = 0
             ry = 0
         else:
             # if only one radius is given, it means both are the same
             if None == rx:
-                rx = float(ry)
-            else:
-                rx = float(rx)
+                rx = ry
             if None == ry:
-                ry = float(rx)
-            else:
-                ry = float(ry)
+                ry = rx
 
         if rx == 0 and ry == 0:
-            pathData = "M %f %f %f %f %f %f %f %f z" % (x,y, x+width,y, x+width, y+height, x, y+height)
+            commands = [ ('M', (x, y)), ('L', (x+width, y)), ('L', (x+width, y+height)),
+                ('L', (x, y+height)), ('z', ()) ]
         else:
-            pathData = "M %f %f A %f %f 0 0 1 %f %f" % (x, y+ry, rx,ry, x+rx, y)
-            pathData += " L %f %f A %f %f 0 0 1 %f %f" % (x+width-rx, y, rx,ry, x+width, y+ry)
-            pathData += " L %f %f A %f %f 0 0 1 %f %f" % (x+width, y+height-ry, rx,ry, x+width-rx, y+height)
-            pathData += " L %f %f A %f %f 0 0 1 %f %f z" % (x+rx, y+height, rx,ry, x, y+height-ry)
-        self.elemPath(elem, pathData)
-
-
-
-
-    def attrTransform(self, matrix, transform):
-        """transforms matrix using svg transform attribute"""
-        for ttype, targs in self.reTransformFind.findall(transform):
-            targs = list(map(lambda x: float(x), self.reNumberFind.findall(targs)))
-            if ttype == 'matrix':
-                newmatrix = [ targs[0], targs[1],
-                             targs[2], targs[3],
-                             targs[4], targs[5] ]
-                self.matrixMul(matrix, newmatrix)
-            elif ttype == 'translate':
-                tx = targs[0]
-                ty = targs[1] if len(targs) > 1 else 0
-                newmatrix = [ 1, 0, 0, 1, tx, ty ]
-                self.matrixMul(matrix, newmatrix)
-            elif ttype == 'scale':
-                sx = targs[0]
-                sy = targs[1] if len(targs) > 1 else sx
-                newmatrix = [ sx, 0, 0, sy, 0, 0 ]
-                self.matrixMul(matrix, newmatrix)
-            elif ttype == 'rotate':
-                if len(targs) == 1:
-                    alpha = targs[0]
-                    newmatrix = [ math.cos(alpha), math.sin(alpha),
-                                 -math.sin(alpha), math.cos(alpha),
-                                 0, 0]
-                    self.matrixMul(matrix, newmatrix)
-                else:
-                    alpha = targs[0]
-                    newmatrix = [ 1, 0, 0, 1, targs[1], targs[2] ]
-                    self.matrixMul(matrix, newmatrix)
-                    newmatrix = [ math.cos(alpha), math.sin(alpha),
-                                 -math.sin(alpha), math.cos(alpha),
-                                 0, 0]
-                    self.matrixMul(matrix, newmatrix)
-                    newmatrix = [ 1, 0, 0, 1, -targs[1], -targs[2] ]
-                    self.matrixMul(matrix, newmatrix)
-            elif ttype == 'skewX' or ttype == 'skewY':
-                self.alert("skewX and skewY transformations are not supported", elem)
-            else:
-                print('unknown transform type: ', ttype)
-        return matrix
+            commands = [ ('M', (x, y+ry)), ('A', (rx, ry, 0, 0, 1, x+rx, y)),
+                ('L', (x+width-rx, y)), ('A', (rx, ry, 0, 0, 1, x+width, y+ry)),
+                ('L', (x+width, y+height-ry)), ('A', (rx, ry, 0, 0, 1, x+width-rx, y+height)),
+                ('L', (x+rx, y+height)), ('A', (rx, ry, 0, 0, 1, x, y+height-ry)), ('z', ()) ]
+        self.elemPath(elem, commands=commands)
+
+    def elemEllipse(self, elem, circle=False):
+        """handles <circle> and <ellipse> svg elements"""
+        if circle:
+            lengths = self.lengthAttrs(elem, ('cx', 'cy', 'r', 'r'))
+        else:
+            lengths = self.lengthAttrs(elem, ('cx', 'cy', 'rx', 'ry'))
+        if None == lengths:
+            return
+        cx, cy, rx, ry = lengths
+        if rx <= 0 or ry <= 0:
+            return # not rendered
+
+        # four quarter arcs, clockwise from the rightmost point
+        points = [ (cx + rx, cy), (cx, cy + ry), (cx - rx, cy), (cx, cy - ry), (cx + rx, cy) ]
+        commands = [ ('M', points[0]) ]
+        for i in range(4):
+            commands.append( ('C', quarterArc(points[i][0], points[i][1],
+                points[i+1][0], points[i+1][1], 1)) )
+        commands.append( ('z', ()) )
+        self.elemPath(elem, commands=commands)
+
+    def elemLine(self, elem):
+        """handles <line> svg element"""
+        lengths = self.lengthAttrs(elem, ('x1', 'y1', 'x2', 'y2'))
+        if None == lengths:
+            return
+        x1, y1, x2, y2 = lengths
+        self.elemPath(elem, commands=[ ('M', (x1, y1)), ('L', (x2, y2)) ])
+
+    def elemPolyline(self, elem, close=False):
+        """handles <polyline> and (with close) <polygon> svg elements"""
+        try:
+            coords = [float(token) for token in rePathToken.findall(elem.get('points', ''))]
+        except ValueError:
+            self.alert("invalid points", elem)
+            return
+        if len(coords) % 2 == 1:
+            self.alert("odd number of point coordinates, the last one is ignored", elem)
+            coords.pop()
+        if len(coords) < 4:
+            return # not rendered
+
+        commands = [ ('M', (coords[0], coords[1])) ]
+        for i in range(2, len(coords), 2):
+            commands.append( ('L', (coords[i], coords[i+1])) )
+        if close:
+            commands.append( ('z', ()) )
+        self.elemPath(elem, commands=commands)
+
+    def attrTransform(self, matrix, transform, elem):
+        """returns matrix transformed by transform, the svg transform
+        attribute of elem"""
+        transformMatrix, alerts = parseTransform(transform)
+        for string in alerts:
+            self.alert(string, elem)
+        return composeMatrix(matrix, transformMatrix)
+
+    def elemById(self, elemId):
+        """returns the element with the given id using the id index, or None"""
+        return self.idIndex.get(elemId)
+
+    def gradientById(self, gradientId):
+        """returns the gradient definition with the given id, or None.
+        Gradients that are referenced before their definition is reached
+        are looked up in the id index."""
+        if gradientId not in self.gradients:
+            elem = self.elemById(gradientId)
+            if None == elem:
+                return None
+            shortTag = elem.tag.split('}')[-1]
+            if 'linearGradient' == shortTag:
+                self.elemGradient(elem, 'linear')
+            elif 'radialGradient' == shortTag:
+                self.elemGradient(elem, 'radial')
+        return self.gradients.get(gradientId)
 
     def elemGradient(self, elem, grType):
         """handles <linearGradient> and <radialGradient> svg elements"""
         elemId  = elem.get('id')
-        if elemId != None:
-            self.curGradientId = elemId
-            self.gradients[elemId] = {'stops': [], 'linUseCount': 0, 'radUseCount': 0, 'type': grType}
+        if elemId != None and elemId not in self.gradients:
+            self.gradients[elemId] = {'stops': [], 'type': grType}
             if 'linear' == grType:
                 x1 = elem.get('x1')
                 if None != x1:
@@ -643,82 +1688,142 @@ class svg2eps:
 
             transform = elem.get('gradientTransform')
             if None != transform:
-                self.gradients[elemId]['matrix'] = self.attrTransform([1, 0, 0, 1, 0, 0], transform)
+                self.gradients[elemId]['matrix'] = self.attrTransform(identityMatrix, transform, elem)
 
             href = elem.get('{http://www.w3.org/1999/xlink}href')
             if None != href:
                 self.gradients[elemId]['href'] = href[1:]
 
+            for child in elem:
+                if 'stop' == child.tag.split('}')[-1]:
+                    self.elemStop(child, self.gradients[elemId])
+
 
-    def elemStop(self, elem):
+    def elemStop(self, elem, gradient):
         """handles <stop> (gradient stop) svg element"""
-        style = css2dict(elem.get('style'))
-        color = cssColor2Eps(style['stop-color'], 'CMYKRGB')
+        style = self.styles.parse(elem.get('style'))
+        stopColor = style.get('stop-color', elem.get('stop-color', 'black'))
+        color = cssColor2Eps(stopColor, 'CMYKRGB', self.fmt)
+        if None == color:
+            self.alert("unsupported color: " + stopColor, elem)
+            color = cssColor2Eps('black', 'CMYKRGB', self.fmt)
         offset = float(elem.get('offset')) * 100
-        self.gradients[self.curGradientId]['stops'].append( (offset, color) )
+        gradient['stops'].append( (offset, color) )
 
     def gradientSetup(self):
         """writes used gradient definitions into self.epsSetup"""
-        gradientNum = 0
-        epsGradients = ""
-        for gradientId, gradient in self.gradients.items():
+        epsGradients = []
+        for (prefix, stops), name in self.gradientNames.items():
+            epsGradients.append(("\n%%AI5_BeginGradient: (%s)" + \
+                "\n(%s) %d %d Bd\n[\n") % \
+                (name, name, 'r_' == prefix, len(stops)))
+            # stable sort, stops at the same offset keep their order
+            for offset, color in sorted(stops, key=lambda x: x[0], reverse='l_' == prefix):
+                epsGradients.append("%s 2 50 %s %%_Bs\n" % (color, self.fmt.number(offset)))
+            epsGradients.append("BD\n%AI5_EndGradient\n")
 
-            if gradient['linUseCount'] > 0:
-                gradientNum += 1
-                epsGradients += ("\n%%AI5_BeginGradient: (l_%s)" + \
-                    "\n(l_%s) 0 %d Bd\n[\n") % \
-                    (gradientId, gradientId, len(gradient['stops']))
-                gradient['stops'].sort(key=lambda x: x[0], reverse=True)
-
-                for offset, color in gradient['stops']:
-                    epsGradients += "%s 2 50 %f %%_Bs\n" % (color, offset)
-                epsGradients += "BD\n%AI5_EndGradient\n"
-
-            if gradient['radUseCount'] > 0:
-                gradientNum += 1
-                epsGradients += ("\n%%AI5_BeginGradient: (r_%s)" + \
-                    "\n(r_%s) 1 %d Bd\n[\n") % \
-                    (gradientId, gradientId, len(gradient['stops']))
-                gradient['stops'].sort(key=lambda x: x[0])
-
-                for offset, color in gradient['stops']:
-                    epsGradients += "%s 2 50 %f %%_Bs\n" % (color, offset)
-                epsGradients += "BD\n%AI5_EndGradient\n"
-
-        if gradientNum > 0:
-            self.epsSetup += ("\n%d Bn\n" % gradientNum) + epsGradients
+        if len(self.gradientNames) > 0:
+            self.epsSetup += ("\n%d Bn\n" % len(self.gradientNames)) + ''.join(epsGradients)
 
 
     def layerStart(self, elem):
-        self.epsLayers += '\n\n%AI5_BeginLayer\n'
+        self.gstate.forget()
+        self.body.write('\n\n%AI5_BeginLayer\n')
         layerName = elem.get('{http://www.inkscape.org/namespaces/inkscape}label')
         layerName = "".join(map(lambda x: '_' if ord(x)<32 or ord(x) > 127 else x, layerName))
-        self.epsLayers += '1 1 1 1 0 0 %d 0 0 0 Lb\n(%s) Ln\n' % \
-            (self.layerColor, layerName)
+        if self.markLayerColors:
+            # previous layers are not known in a layer worker, mergeLayer()
+            # replaces the mark (xml text can not contain it) with the color
+            colorText = '\0'
+        else:
+            colorText = '%d' % self.layerColor
+        self.body.write('1 1 1 1 0 0 %s 0 0 0 Lb\n(%s) Ln\n' % \
+            (colorText, layerName))
         self.layerColor = (self.layerColor + 1) % 27
 
-    def elemUse(self, elem):
-        """handles a <use> svg element"""
-        x = self.unitConv(elem.get('x'), 'uu')
+    def elemUse(self, elem, stack):
+        """handles a <use> svg element: pushes the walk events of the used
+        element onto the walk stack (see walkElem())"""
+        x = elem.get('x')
         if x == None:
             x = 0
-        y = self.unitConv(elem.get('y'), 'uu')
+        else:
+            x = self.unitConv(x, 'uu')
+        y = elem.get('y')
         if y == None:
             y = 0
+        else:
+            y = self.unitConv(y, 'uu')
 
-        if x != 0 or y != 0:
-            self.matrices.append( self.matrices[-1][:] )
-            self.attrTransform(self.matrices[-1], "translate(%f %f)" % (x, y))
+        translated = x != 0 or y != 0
+        if translated:
+            self.matrices.append( composeMatrix(self.matrices[-1], (1, 0, 0, 1, x, y)) )
+        stack.append( ('useEnd', translated) )
 
         href = elem.get('{http://www.w3.org/1999/xlink}href')
-        usedElem = self.root.find(".//*[@id='%s']" % (href[1:],))
-        if usedElem != None:
-            self.walkElem(usedElem)
-        else:
+        usedElem = self.elemById(href[1:])
+        if usedElem == None:
             self.alert("used Elem not found: " + href, elem)
+        elif usedElem in self.openElems:
+            self.alert("circular reference ignored: " + href, elem)
+        elif self.useProcedures and not self.clipPath:
+            # clip paths must be expanded, because W works on the path itself
+            if self.section == 'defs':
+                return # nothing is drawn in defs, clones are drawn where they are used
+            self.useProcedure(usedElem, stack)
+        else:
+            stack.append( ('enter', usedElem) )
+
+    def useProcedure(self, usedElem, stack):
+        """pushes the walk events that call the PostScript procedure drawing
+        usedElem with the current inherited style in its own coordinate
+        system. The procedure is generated on first use (between 'procBegin'
+        and 'procEnd' events), and written into the setup section by
+        convert()."""
+        key = (usedElem.get('id'), self.cssStack[-1].serial)
+        procName = self.procedureNames.get(key)
+        if None != procName:
+            stack.append( ('procCall', procName) )
+            return
 
-        if x != 0 or y != 0:
-            self.matrices.pop()
+        # numbered on registration: nested procedures are finished first
+        procName = 'sym_%d' % (len(self.procedureNames) + 1,)
+        self.procedureNames[key] = procName
+        stack.append( ('procCall', procName) )
+        stack.append( ('procEnd', procName) )
+        stack.append( ('enter', usedElem) )
+        stack.append( ('procBegin',) )
+
+    def procedureBegin(self):
+        """starts collecting the body of a procedure, see procedureEnd()"""
+        self.procedureCaptures.append( (self.body, self.matrices, self.gstate, self.section) )
+        self.procedureFragments.append(StringIO())
+        self.body = epsWriter(self.procedureFragments[-1])
+        self.matrices = [ identityMatrix ]
+        self.gstate = graphicsState() # state at the call site is not known
+        self.section = None # the procedure draws, even if it is first used in defs
+        self.boxes.append(None)
+
+    def procedureEnd(self, procName):
+        """finishes the body of procedure procName"""
+        self.procedureBoxes[procName] = self.boxes.pop()
+        self.body.flush()
+        self.body, self.matrices, self.gstate, self.section = self.procedureCaptures.pop()
+        self.procedures.append( (procName, self.procedureFragments.pop().getvalue()) )
+
+    def procedureCall(self, procName):
+        """writes the call of procedure procName with the current matrix"""
+        self.body.write("\ngsave [ %s ] concat %s grestore\n" % \
+            (self.fmt.numbers(self.matrices[-1]), procName))
+        # grestore does not restore the variables set by XA and XR
+        self.gstate.forget()
+        if self.tightBoundingBox:
+            self.addBox(transformBox(self.procedureBoxes[procName], self.matrices[-1]))
+
+    def procedureSetup(self):
+        """writes procedures of used elements into self.epsSetup"""
+        for procName, procBody in self.procedures:
+            self.epsSetup += "\n/%s {%s\n} def\n" % (procName, procBody)
 
     # def elemNamedView(self, elem):
     #     """handles a <sodipodi:namedview> svg element"""
@@ -731,7 +1836,56 @@ class svg2eps:
     #             self.matrices[-1][3] = scale * self.matrices[-1][3]
     #         self.documentUnit = newDocumentUnit
 
-    def walkElem(self, elem):
+    def walkElem(self, root):
+        """walks the svg tree under root and writes the eps body.
+        The tree is walked with an explicit stack of events instead of
+        recursion, so deep nesting and long clone chains do not hit the
+        recursion limit. Events are popped in order:
+        ('enter', elem) - computes style, transform and clip of elem
+        ('clipBegin',), ('enter', clip path), ('clipEnd', ...) - collect and
+            write the clip path of the entered elem, unless it is cached
+        ('start', elem, shortTag, clipPath) - handles elem itself
+        ('enter', child) - for each child (and used element)
+        ('procBegin',), ('enter', used elem), ('procEnd', name) - generate
+            the procedure of a <use>, see useProcedure()
+        ('procCall', name) - calls the procedure of a <use>
+        ('useEnd', translated) - after the element used by a <use>
+        ('exit', elem, shortTag, clipPath, transformed) - closes elem"""
+        self.walkEvents([ ('enter', root) ])
+
+    def walkEvents(self, stack):
+        """processes the events of stack until it is empty, see walkElem()"""
+        while stack:
+            event = stack.pop()
+            if 'enter' == event[0]:
+                self.enterElem(event[1], stack)
+            elif 'start' == event[0]:
+                self.startElem(event[1], event[2], event[3], stack)
+            elif 'exit' == event[0]:
+                self.exitElem(event[1], event[2], event[3], event[4])
+            elif 'procBegin' == event[0]:
+                self.procedureBegin()
+            elif 'procEnd' == event[0]:
+                self.procedureEnd(event[1])
+            elif 'procCall' == event[0]:
+                self.procedureCall(event[1])
+            elif 'clipBegin' == event[0]:
+                self.clipBegin()
+            elif 'clipEnd' == event[0]:
+                self.clipEnd(event[1], event[2], event[3])
+            elif 'useEnd' == event[0]:
+                if event[1]:
+                    self.matrices.pop()
+
+    def enterElem(self, elem, stack, children=True):
+        """computes style, transform and clip of elem and pushes its events,
+        see walkElem(). The events of the children are not pushed if children
+        is False. Nothing is pushed if elem is not visible."""
+        if not hasattr(elem.tag, 'split'):
+            return # comment or processing instruction
+        if len(self.layerResults) > 0 and elem in self.layerResults:
+            self.finishLayer(elem)
+            return
         if '}' in elem.tag:
             uri, shortTag = elem.tag.split('}')
         else:
@@ -740,54 +1894,124 @@ class svg2eps:
 
         transform = elem.get('transform')
         clipPath = elem.get('clip-path')
-        cssNew = css2dict(elem.get('style'))
-        css = self.cssStack[-1].copy()
-        css.update(cssNew)
-        self.cssStack.append(css)
-        if self.removeInvisible:
-            if 'visibility' in css and (css['visibility'] == 'hidden' or css['visibility'] == 'collapse'):
-                return
-            if 'display' in css and css['display'] == 'none':
-                return
-            if shortTag in ('path', 'rect'):
-                if 'opacity' in css and css['opacity'] == '0':
-                    return
-                stroke = False
-                if 'stroke' in css and 'none' != css['stroke']:
-                    stroke = True
-                    if 'stroke-opacity' in css and css['stroke-opacity'] == '0':
-                        stroke = False
-                    if 'stroke-width' in css and css['stroke-width'] == '0':
-                        stroke = False
-                fill = False
-                if 'fill' in css and 'none' != css['fill']:
-                    fill = True
-                    if 'fill-opacity' in css and css['fill-opacity'] == '0':
-                        stroke = False
-                if stroke == False and fill == False:
-                    return
-
+        css = self.styles.compute(self.cssStack[-1], elem.get('style'))
+        if self.removeInvisible and self.isInvisible(shortTag, css):
+            return
 
+        self.cssStack.append(css)
+        self.openElems.add(elem)
         if transform != None:
-            self.matrices.append( self.matrices[-1][:] )
-            self.attrTransform(self.matrices[-1], transform)
+            self.matrices.append( self.attrTransform(self.matrices[-1], transform, elem) )
 
+        clipElem = None
         if None != clipPath:
             clipId = clipPath[5:-1]
-            clipElem = self.root.find(".//*[@id='%s']" % (clipId,))
+            clipElem = self.elemById(clipId)
             if clipElem == None:
                 self.alert('clipPath not found', elem)
                 clipPath = None
+            elif clipElem in self.openElems:
+                self.alert('circular reference ignored: #' + clipId, elem)
+                clipPath = None
+                clipElem = None
+
+        stack.append( ('exit', elem, shortTag, clipPath, transform != None) )
+        if children:
+            for child in reversed(list(elem)):
+                stack.append( ('enter', child) )
+        stack.append( ('start', elem, shortTag, clipPath) )
+
+        if None != clipElem:
+            self.body.write("\nq\n")
+            self.gstate.push()
+            css = self.cssStack[-1]
+            key = (clipId, self.matrices[-1], self.section,
+                css.get('visibility'), css.get('display'))
+            cached = self.clipCache.get(key)
+            if None == cached:
+                stack.append( ('clipEnd', clipId, clipElem, key) )
+                stack.append( ('enter', clipElem) )
+                stack.append( ('clipBegin',) )
             else:
-                self.epsLayers += "\nq\n"
-                clipPathSave= self.clipPath
-                self.clipPath = True
-                self.walkElem(clipElem)
-                self.clipPath = clipPathSave
-                self.epsLayers += ' W'
-
+                self.writeClip(cached)
+
+    def clipBegin(self):
+        """starts collecting the text of a clip path, see clipEnd()"""
+        self.clipCaptures.append( (self.body, self.clipPath, dict(self.gstate.values)) )
+        self.clipFragments.append(StringIO())
+        self.body = epsWriter(self.clipFragments[-1])
+        self.clipPath = True
+        self.boxes.append(None)
+
+    def clipEnd(self, clipId, clipElem, key):
+        """writes the collected text of a clip path, and caches it under key
+        (clip id, matrix, section, visibility, display): elements clipped by
+        the same clip path with the same matrix reuse it. Clip paths that
+        refer to other elements (<use>, clip-path) are not cached, because
+        their output depends on the elements being walked (circular
+        references)."""
+        self.body.flush()
+        self.body, self.clipPath, gstateValues = self.clipCaptures.pop()
+        cached = (self.clipFragments.pop().getvalue(), self.boxes.pop())
+        if gstateValues == self.gstate.values and self.isClipCacheable(clipId, clipElem):
+            self.clipCache.set(key, cached)
+        self.writeClip(cached)
+
+    def writeClip(self, clip):
+        """writes the (text, bounding box) of a clip path, up to W"""
+        self.body.write(clip[0])
+        self.body.write(' W')
+        if self.tightBoundingBox:
+            # the clip path is collected, now the clipped content
+            self.clipBoxes.append(clip[1])
+            self.boxes.append(None)
+
+    def isClipCacheable(self, clipId, clipElem):
+        """tells if the output of clip path clipElem depends only on the
+        matrix, see clipEnd()"""
+        cacheable = self.clipCacheable.get(clipId)
+        if None == cacheable:
+            cacheable = True
+            for elem in clipElem.iter():
+                if None != elem.get('clip-path') or \
+                        None != elem.get('{http://www.w3.org/1999/xlink}href'):
+                    cacheable = False
+                    break
+            self.clipCacheable[clipId] = cacheable
+        return cacheable
+
+    def isInvisible(self, shortTag, css):
+        """tells if an element with computed style css is not visible"""
+        if 'visibility' in css and (css['visibility'] == 'hidden' or css['visibility'] == 'collapse'):
+            return True
+        if 'display' in css and css['display'] == 'none':
+            return True
+        # paint does not matter in clip paths, only the geometry
+        if shortTag in shapeTags and not self.clipPath:
+            if 'opacity' in css and css['opacity'] == '0':
+                return True
+            stroke = False
+            if 'stroke' in css and isPaint(css['stroke']):
+                stroke = True
+                if 'stroke-opacity' in css and css['stroke-opacity'] == '0':
+                    stroke = False
+                if 'stroke-width' in css and css['stroke-width'] == '0':
+                    stroke = False
+            fill = False
+            if 'fill' in css and isPaint(css['fill']):
+                fill = True
+                if 'fill-opacity' in css and css['fill-opacity'] == '0':
+                    stroke = False
+            if stroke == False and fill == False:
+                return True
+        return False
+
+    def startElem(self, elem, shortTag, clipPath, stack):
+        """handles elem after its clip path, before its children"""
         if 'svg' == shortTag:
             self.elemSvg(elem)
+            if (None != self.layerPool or None != self.layerCache) and 1 == len(self.cssStack) - 1:
+                self.startLayerJobs(elem)
         elif 'path' == shortTag:
             # do not output paths that are in defs
             # if they are referenced, they will be used there
@@ -796,19 +2020,28 @@ class svg2eps:
         elif 'rect' == shortTag:
             if self.section != 'defs':
                 self.elemRect(elem)
+        elif 'circle' == shortTag or 'ellipse' == shortTag:
+            if self.section != 'defs':
+                self.elemEllipse(elem, 'circle' == shortTag)
+        elif 'line' == shortTag:
+            if self.section != 'defs':
+                self.elemLine(elem)
+        elif 'polyline' == shortTag or 'polygon' == shortTag:
+            if self.section != 'defs':
+                self.elemPolyline(elem, 'polygon' == shortTag)
         elif 'linearGradient' == shortTag:
             self.elemGradient(elem, 'linear')
         elif 'radialGradient' == shortTag:
             self.elemGradient(elem, 'radial')
         elif 'stop' == shortTag:
-            self.elemStop(elem)
+            pass # stops are read by elemGradient()
         elif 'g' == shortTag:
             if 'layer' == elem.get('{http://www.inkscape.org/namespaces/inkscape}groupmode'):
                 self.layerStart(elem)
             elif None == clipPath: # clipping makes a group anyway
-                self.epsLayers += '\nu\n'
+                self.body.write('\nu\n')
         elif 'use' == shortTag:
-            self.elemUse(elem)
+            self.elemUse(elem, stack)
         elif 'defs' == shortTag:
             self.section = shortTag
         elif 'namedview' == shortTag:
@@ -816,49 +2049,277 @@ class svg2eps:
         else:
             self.alert("unhandled elem: " + shortTag, elem)
 
-
-        for child in list(elem):
-            self.walkElem(child)
-
+    def exitElem(self, elem, shortTag, clipPath, transformed):
+        """closes elem after its children"""
         if None != clipPath:
-            self.epsLayers += "\nQ\n"
+            self.body.write("\nQ\n")
+            self.gstate.pop()
+            if self.tightBoundingBox:
+                box = self.boxes.pop()
+                clipBox = self.clipBoxes.pop()
+                if None != box and None != clipBox:
+                    box = [max(box[0], clipBox[0]), max(box[1], clipBox[1]),
+                        min(box[2], clipBox[2]), min(box[3], clipBox[3])]
+                    if box[0] > box[2] or box[1] > box[3]:
+                        box = None # clipped away
+                elif None == clipBox:
+                    box = None # empty clip path
+                self.addBox(box)
 
         if 'g' == shortTag:
             if 'layer' == elem.get('{http://www.inkscape.org/namespaces/inkscape}groupmode'):
-                self.epsLayers += '\nLB\n%AI5_EndLayer\n'
+                self.body.write('\nLB\n%AI5_EndLayer\n')
+                self.gstate.forget()
             elif None == clipPath:
-                self.epsLayers += '\nU\n'
+                self.body.write('\nU\n')
         elif shortTag in ('defs', 'namedview'):
             self.section = None
 
-        if transform != None:
+        if transformed:
             self.matrices.pop()
 
         self.cssStack.pop()
-
-    def convert(self, svg = None):
-        self.alerts = {}
-        if None != svg:
-            self.svg = svg
-        if None == self.svg and None != self.filename:
-            fd = open(self.filename, 'rb')
-            self.svg = fd.read()
-            fd.close()
-
-        self.autoClose = True # TODO: make it optional
-        self.removeInvisible = True # TODO: make it optional
-        self.removeStrayPoints = True # TODO: make it optional
-        # if last point of a path is further from first point, then an explicit
-        # 'lineto' is written to the first point before 'closepath'
-        self.closeDist = 0.1
-        self.matrices = [[1, 0, 0, 1, 0, 0]]
-        self.cssStack = [{}]
-        self.gradients = {}
+        self.openElems.discard(elem)
+
+    def startLayerPool(self, svg, root):
+        """starts the worker processes of parallel layer conversion (see
+        svg2eps.layerJobs), returns None if layers are converted here"""
+        if self.useProcedures or 1 == self.layerJobs or 0 == self.layerJobs:
+            # procedure names are numbered across the whole document
+            return None
+        layerCount = len([child for child in root if isLayer(child)])
+        if layerCount < 2:
+            return None
+        import multiprocessing
+        jobs = self.layerJobs or multiprocessing.cpu_count()
+        return multiprocessing.Pool(min(jobs, layerCount), layerWorkerInit, (svg, self.converter.options()))
+
+    def startLayerJobs(self, root):
+        """looks up the top level layers of root in the layer cache, and sends
+        the others to the layer workers. They are converted with the current
+        transformation and style, which do not change between the children
+        of root. See finishLayer()."""
+        css = list(self.cssStack[-1].items())
+        for index, child in enumerate(root):
+            if isLayer(child):
+                job = (index, self.matrices[-1], css, self.toPt, self.docWidth, self.docHeight)
+                key = None
+                result = None
+                pending = None
+                if None != self.layerCache:
+                    key = self.layerCacheKey(child, job)
+                    result = self.layerCache.get(key)
+                if None == result and None != self.layerPool:
+                    pending = self.layerPool.apply_async(layerWorkerConvert, (job,))
+                self.layerResults[child] = (job, key, pending, result)
+
+    def layerCacheKey(self, layer, job):
+        """returns the layer cache key of a layer: a hash of its xml, the xml
+        of the elements it references (directly or indirectly), the state it
+        is converted in (job) and the converter options"""
+        import hashlib
+
+        etree = loadEtree()
+        if hasattr(etree, 'LXML_VERSION'):
+            tostring = lambda elem: etree.tostring(elem, with_tail=False)
+        else:
+            tostring = etree.tostring
+        digest = hashlib.sha1()
+        digest.update(repr( (moduleDigest(), self.converter.outputOptions(), job[1:]) ).encode('utf-8'))
+        digest.update(tostring(layer))
+        refs = set()
+        for elem in layer.iter():
+            collectReferences(elem, refs)
+        done = set()
+        while len(refs) > 0:
+            refId = min(refs)
+            refs.remove(refId)
+            done.add(refId)
+            refElem = self.elemById(refId)
+            if None == refElem:
+                digest.update(('\0missing ' + refId).encode('utf-8'))
+                continue
+            digest.update(('\0ref ' + refId + '\0').encode('utf-8'))
+            digest.update(tostring(refElem))
+            for elem in refElem.iter():
+                collectReferences(elem, refs)
+            refs.difference_update(done)
+        return digest.hexdigest()
+
+    def finishLayer(self, layer):
+        """merges the converted top level layer into the body: from the layer
+        cache, from a layer worker, or converting it now"""
+        job, key, pending, result = self.layerResults.pop(layer)
+        if None == result:
+            if None != pending:
+                result = pending.get()
+            else:
+                result = conversionContext(self.converter).runLayer(layer, self.idIndex, job)
+            if None != key:
+                self.layerCache.set(key, result)
+        self.mergeLayer(result)
+
+    def runLayer(self, layer, idIndex, job):
+        """converts one top level layer with a fresh state, for a layer worker
+        or the layer cache. See layerWorkerConvert()"""
+        index, matrix, css, toPt, docWidth, docHeight = job
+        self.initState()
+        self.docWidth = docWidth
+        self.docHeight = docHeight
+        self.markLayerColors = True
+        self.idIndex = idIndex
+        self.toPt = dict(toPt)
+        self.matrices = [ tuple(matrix) ]
+        self.cssStack = [ self.styles.newStyle(css) ]
+        fragment = StringIO()
+        self.body = epsWriter(fragment)
+        self.walkElem(layer)
+        self.body.flush()
+        return {'fragment': fragment.getvalue(), 'gradientNames': list(self.gradientNames.items()),
+            'alerts': self.alerts, 'docWidth': self.docWidth, 'docHeight': self.docHeight,
+            'toPt': self.toPt, 'box': self.boxes[0], 'statistics': self.statistics}
+
+    def mergeLayer(self, result):
+        """writes the result of a layer worker into the body as if the layer
+        was converted here"""
+        for key, name in result['gradientNames']:
+            if not key in self.gradientNames:
+                self.gradientNames[key] = name
+        pieces = result['fragment'].split('\0')
+        self.body.write(pieces[0])
+        for piece in pieces[1:]:
+            self.body.write('%d' % self.layerColor)
+            self.layerColor = (self.layerColor + 1) % 27
+            self.body.write(piece)
+        for string, ids in result['alerts'].items():
+            if not string in self.alerts:
+                self.alerts[string] = set()
+            self.alerts[string].update(ids)
+        self.docWidth = result['docWidth']
+        self.docHeight = result['docHeight']
+        self.toPt = result['toPt']
+        self.addBox(result['box'])
+        self.statistics['removedPoints'].update(result['statistics']['removedPoints'])
+        self.gstate.forget()
+
+    def streamIndex(self, svgPath, wanted=None):
+        """first pass of the streaming conversion: collects the ids referenced
+        by xlink:href, clip-path and url() style values, and keeps the subtrees
+        of referenced elements in self.idIndex. Only elements referenced before
+        their start are known in one pass; if wanted is a set of ids, exactly
+        those are kept instead. Returns the referenced ids."""
+        refs = set()
+        if None == wanted:
+            keepIds = refs
+        else:
+            keepIds = wanted
+        parents = []
+        keepDepth = 0 # depth inside the kept subtree
+        for event, elem in iterparseFile(svgPath):
+            if 'start' == event:
+                if None == wanted:
+                    collectReferences(elem, refs)
+                if keepDepth > 0:
+                    keepDepth += 1
+                elif len(parents) > 0 and elem.get('id') in keepIds:
+                    keepDepth = 1
+                parents.append(elem)
+            else:
+                parents.pop()
+                if keepDepth > 0:
+                    elemId = elem.get('id')
+                    if None != elemId and elemId not in self.idIndex:
+                        self.idIndex[elemId] = elem
+                    keepDepth -= 1
+                    if keepDepth > 0:
+                        continue
+                if len(parents) > 0:
+                    parents[-1].remove(elem)
+        return refs
+
+    def streamWalk(self, svgPath):
+        """second pass of the streaming conversion: converts the elements while
+        the document is parsed, and drops them when they end. Referenced
+        elements are converted from their copy in self.idIndex."""
+        parents = []
+        exits = [] # exit events of the open elements
+        skipDepth = 0 # depth inside a skipped (invisible or indexed) subtree
+        for event, elem in iterparseFile(svgPath):
+            if 'start' == event:
+                if skipDepth > 0:
+                    skipDepth += 1
+                elif len(parents) > 0 and elem.get('id') in self.idIndex:
+                    self.walkElem(self.idIndex[elem.get('id')])
+                    skipDepth = 1
+                else:
+                    stack = []
+                    self.enterElem(elem, stack, False)
+                    if len(stack) > 0:
+                        exits.append(stack.pop(0))
+                        self.walkEvents(stack)
+                    else:
+                        skipDepth = 1
+                parents.append(elem)
+            else:
+                parents.pop()
+                if skipDepth > 0:
+                    skipDepth -= 1
+                else:
+                    self.walkEvents([exits.pop()])
+                if len(parents) > 0:
+                    parents[-1].remove(elem)
+
+    def streamDocument(self, svgPath):
+        """converts the svg file at svgPath without building its whole tree,
+        see svg2eps.streaming"""
+        refs = self.streamIndex(svgPath)
+        missing = refs.difference(self.idIndex)
+        if len(missing) > 0:
+            # referenced before their definition
+            self.streamIndex(svgPath, missing)
+        self.streamWalk(svgPath)
+
+    def initState(self):
+        """initializes the conversion state"""
+        self.matrices = [ identityMatrix ]
+        self.cssStack = [self.styles.root]
+        self.gstate = graphicsState()
+        self.gradients = {} # gradient id -> definition, see elemGradient()
+        self.gradientChains = {} # gradient id -> resolveGradient() result
+        # (prefix, stops) -> name of the gradient definition, in order of first use
+        self.gradientNames = OrderedDict()
+        self.procedures = [] # (name, body) pairs of PostScript procedures for used elements
+        self.procedureNames = {} # (used element id, inherited style serial) -> procedure name
+        self.procedureCaptures = [] # (body, matrices, gstate, section) saved by procedureBegin()
+        self.procedureFragments = [] # bodies of the procedures being generated
         self.docHeight = 400
         self.docWidth = 400
         self.layerColor = 0
+        self.markLayerColors = False # set in layer workers, see mergeLayer()
+        self.layerPool = None # see startLayerPool()
+        self.layerResults = {} # top level layer elem -> result of layerWorkerConvert()
         self.section = None
         self.clipPath = False
+        self.openElems = set() # elements being walked, to detect circular references
+        # bounding boxes being collected in eps coordinates: of the document,
+        # of clip paths and clipped contents, and of procedures
+        self.boxes = [None]
+        self.clipBoxes = [] # bounding boxes of the clip paths of the open clipped elements
+        # (clip id, matrix, section, visibility, display) -> (eps text, bounding box)
+        self.clipCache = lruCache(1024)
+        self.clipCacheable = {} # clip id -> isClipCacheable()
+        self.clipCaptures = [] # (body, clipPath, graphics state values) saved by clipBegin()
+        self.clipFragments = [] # text of the clip paths being collected
+        self.procedureBoxes = {} # procedure name -> bounding box in its own coordinates
+
+    def run(self, svg, out, svgPath=None):
+        """converts the svg document data (or streams the file at svgPath, if
+        svg is None) and writes the eps to out, see svg2eps.convert()
+
+        The body is streamed into a temporary file, so that the header (which
+        depends on the whole document) can be written first without keeping
+        the body in memory."""
+        self.initState()
         self.epsComments = """%!PS-Adobe-3.0 EPSF-3.0
 %%Creator: tzunghaor svg2eps
 %%Pages: 1
@@ -916,8 +2377,9 @@ class svg2eps:
              /tzung_closeop {F} def
          } ifelse } bind def
     /f { closepath F } bind def
+    % strokes keep the current color, which is the fill color set by Xa
     /S { tzung_compound 0 eq {
-            tzung_strokergb aload pop setrgbcolor stroke
+            gsave tzung_strokergb aload pop setrgbcolor stroke grestore newpath
         } {
              /tzung_closeop {S} def
         } ifelse } bind def
@@ -927,7 +2389,7 @@ class svg2eps:
             gsave
             tzung_fillrule 0 eq { fill } { eofill } ifelse
             grestore
-            tzung_strokergb aload pop setrgbcolor stroke
+            gsave tzung_strokergb aload pop setrgbcolor stroke grestore newpath
          } {
              /tzung_closeop {B} def
         } ifelse } bind def
@@ -1065,7 +2527,6 @@ class svg2eps:
     Adobe_Illustrator_AI5 /initialize get exec
 } if
 """
-        self.epsLayers = ""
         self.epsTrailer = """%%Trailer
 showpage
 count op_count sub {pop} repeat
@@ -1075,13 +2536,40 @@ end
 %%EOF
 """
 
+        returnString = None == out
+        if returnString:
+            out = StringIO()
+
+        import tempfile
+        import shutil
 
-        self.root = ET.fromstring(self.svg)
-        self.walkElem(self.root)
+        bodyFile = tempfile.SpooledTemporaryFile(max_size=self.bodyMemSize, mode='w+')
+        self.body = epsWriter(bodyFile)
+        self.idIndex = {}
+        if None == svg:
+            self.streamDocument(svgPath)
+        else:
+            root = parseSvg(svg)
+            self.idIndex = indexIds(root)
+            self.layerPool = self.startLayerPool(svg, root)
+            try:
+                self.walkElem(root)
+            finally:
+                if None != self.layerPool:
+                    self.layerPool.terminate()
+                    self.layerPool.join()
+        self.body.flush()
         self.gradientSetup()
+        self.procedureSetup()
 
-        sizeComment = "%%%%BoundingBox: 0 0 %d %d\n" % (math.ceil(self.docWidth), math.ceil(self.docHeight))
-        sizeComment += "%%%%HiResBoundingBox: 0 0 %f %f\n" % (self.docWidth, self.docHeight)
+        box = self.boxes[0]
+        if self.tightBoundingBox and None != box:
+            sizeComment = "%%%%BoundingBox: %d %d %d %d\n" % \
+                (math.floor(box[0]), math.floor(box[1]), math.ceil(box[2]), math.ceil(box[3]))
+            sizeComment += "%%%%HiResBoundingBox: %f %f %f %f\n" % tuple(box)
+        else:
+            sizeComment = "%%%%BoundingBox: 0 0 %d %d\n" % (math.ceil(self.docWidth), math.ceil(self.docHeight))
+            sizeComment += "%%%%HiResBoundingBox: 0 0 %f %f\n" % (self.docWidth, self.docHeight)
         sizeComment += "%%AI5_ArtSize: %f %f\n" % (self.docWidth, self.docHeight)
         pagesetup = """%%%%Page: 1 1
 %%%%BeginPageSetup
@@ -1089,22 +2577,468 @@ end
 %%%%EndPageSetup
 """ % (self.docWidth, self.docHeight)
 
-        eps = self.epsComments + sizeComment + "%%EndComments\n\n"
-        eps += self.epsProlog  + "\n%%EndProlog\n\n"
-        eps += self.epsSetup + "\n%%EndSetup\n\n"
-        eps += pagesetup + self.epsLayers + "\n\n"
-        eps += self.epsTrailer
+        out.write(self.epsComments + sizeComment + "%%EndComments\n\n")
+        out.write(self.epsProlog  + "\n%%EndProlog\n\n")
+        out.write(self.epsSetup + "\n%%EndSetup\n\n")
+        out.write(pagesetup)
+        bodyFile.seek(0)
+        shutil.copyfileobj(bodyFile, out)
+        bodyFile.close()
+        out.write("\n\n" + self.epsTrailer)
 
-        return eps
+        if returnString:
+            return out.getvalue()
 
-import sys
-
-if len(sys.argv) < 2:
-    print("missing filename")
-    exit(1)
+class svg2eps:
+    """svg to eps converter. It holds only configuration and caches that are
+    shared between conversions (and are safe to use from several threads),
+    so one configured instance can run many conversions, even concurrently.
+    Configuration attributes should not be changed while conversions run."""
+    def __init__(self, filename=None):
+        self.filename = filename
+        # eps body is kept in memory up to this size, then it is spooled to a temporary file
+        self.bodyMemSize = 1 << 20
+        # paths with at least this many points are transformed with numpy (if available)
+        self.useNumpy = True
+        self.numpyMinPoints = 64
+        # export every used element (clone original) once as a PostScript
+        # procedure, and <use> elements as calls of it. This makes much smaller
+        # files with many clones, but Illustrator does not understand it.
+        self.useProcedures = False
+        self.autoClose = True # close every subpath of filled paths
+        self.removeInvisible = True # skip hidden elements and shapes without fill or stroke
+        self.removeStrayPoints = True # drop subpaths that consist of a single moveto
+        # if last point of a path is further from first point, then an explicit
+        # 'lineto' is written to the first point before 'closepath'
+        self.closeDist = 0.1
+        # number of decimals of numbers written into the eps. To set it from a
+        # tolerance in points, use decimalsForTolerance(tolerance).
+        self.decimals = 6
+        # drop trailing zeros and the sign of negative zero from numbers
+        self.compactNumbers = False
+        # files are parsed incrementally (in two or three passes) instead of
+        # building the whole document tree, for documents larger than memory
+        self.streaming = False
+        # number of worker processes converting the top level layers of a
+        # document in parallel (number of CPUs if None). Not used in streaming
+        # mode, and with useProcedures.
+        self.layerJobs = 1
+        # converted top level layers are cached in this directory (if it is
+        # not None), and reused while the layer and everything it depends on
+        # is unchanged. Least recently used files are removed above
+        # cacheMaxSize bytes. useCache = False bypasses the cache.
+        self.cacheDir = None
+        self.cacheMaxSize = 256 << 20
+        self.useCache = True
+        # write the bounding box of the drawing (including strokes and
+        # clipping) into the eps header, instead of the page size
+        self.tightBoundingBox = False
+        # simplify paths within this tolerance (in points), None disables it.
+        # Flat curves become lines, and lines are thinned (Ramer-Douglas-Peucker)
+        self.simplifyTolerance = None
+        self.toPt = {'in': 72.0, 'pt': 1.0, 'mm': 2.8346456695, 'cm': 28.346456695, 'm': 2834.6456695, 'pc': 12.0}
+        self.styles = styleResolver()
+
+    def convert(self, svg = None, out = None, alerts = None, filename = None, statistics = None):
+        """converts the svg document data (or the file filename, by default the
+        one given in the constructor) and writes the eps to out (any file-like
+        object with a write() method). If out is None, the eps is returned as a
+        string. If alerts is a dict, the alerts of the conversion are added to
+        it (see showAlerts()). If statistics is a dict, it gets
+        'removedPoints': path id -> points removed by simplification."""
+        if None == filename:
+            filename = self.filename
+        if None == svg and not self.streaming:
+            fd = open(filename, 'rb')
+            svg = fd.read()
+            fd.close()
 
-converter = svg2eps(sys.argv[1])
+        context = conversionContext(self)
+        try:
+            return context.run(svg, out, filename)
+        finally:
+            if None != alerts:
+                alerts.update(context.alerts)
+            if None != statistics:
+                statistics.update(context.statistics)
+
+    def options(self):
+        """returns the configuration attributes, to set up a converter in
+        another process"""
+        options = dict(self.__dict__)
+        del options['styles']
+        return options
+
+    def outputOptions(self):
+        """returns the sorted (name, value) pairs of the options that may
+        change the output, for the layer cache key"""
+        options = self.options()
+        for name in ('filename', 'bodyMemSize', 'useNumpy', 'numpyMinPoints',
+                'streaming', 'layerJobs', 'cacheDir', 'cacheMaxSize', 'useCache'):
+            del options[name]
+        return sorted(options.items())
+
+    def showAlerts(self, alerts):
+        """show alerts collected by convert()"""
+        for string, ids in alerts.items():
+            idstring = ', '.join(ids)
+            print(string, idstring)
 
-print(converter.convert())
-#TODO: show alerts in dialogbox
-#converter.showAlerts()
+moduleDigestValue = None # set by moduleDigest()
+
+def moduleDigest():
+    """returns a hash of this module's source, so that cached layers are
+    converted again by a new version"""
+    global moduleDigestValue
+    if None == moduleDigestValue:
+        import hashlib
+        fd = open(__file__.replace('.pyc', '.py'), 'rb')
+        moduleDigestValue = hashlib.sha1(fd.read()).hexdigest()
+        fd.close()
+    return moduleDigestValue
+
+class fragmentCache:
+    """on-disk cache of converted layers (see conversionContext.runLayer()),
+    one marshal file per key. Size is bounded by removing the least
+    recently used (oldest modification time) files."""
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+
+    def path(self, key):
+        import os
+        return os.path.join(self.directory, key + '.eps-layer')
+
+    def get(self, key):
+        """returns the cached result, or None"""
+        import os
+        import marshal
+
+        path = self.path(key)
+        try:
+            fd = open(path, 'rb')
+            try:
+                result = marshal.load(fd)
+            finally:
+                fd.close()
+            os.utime(path, None) # mark as recently used
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            # missing, removed meanwhile by an other process, or broken
+            return None
+        return result
+
+    def set(self, key, result):
+        """stores result, then evicts files above the size limit"""
+        import os
+        import marshal
+        import tempfile
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        fd, tempPath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        fd = open(tempPath, 'wb')
+        try:
+            marshal.dump(result, fd)
+        finally:
+            fd.close()
+        path = self.path(key)
+        try:
+            os.rename(tempPath, path)
+        except OSError:
+            # on windows rename does not replace an existing file
+            os.remove(tempPath)
+        self.evict()
+
+    def evict(self):
+        """removes least recently used files until the size is within maxSize"""
+        import os
+
+        files = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.eps-layer'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append( (stat.st_mtime, path, stat.st_size) )
+                total += stat.st_size
+        files.sort()
+        for mtime, path, size in files:
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+layerWorker = None # (converter, document root, id index) in a layer worker process
+
+def layerWorkerInit(svg, options):
+    """initializes a layer worker process: parses the document once"""
+    global layerWorker
+    converter = svg2eps()
+    for name, value in options.items():
+        setattr(converter, name, value)
+    root = parseSvg(svg)
+    layerWorker = (converter, root, indexIds(root))
+
+def layerWorkerConvert(job):
+    """converts one top level layer in a layer worker process, see
+    conversionContext.startLayerJobs()"""
+    converter, root, idIndex = layerWorker
+    context = conversionContext(converter)
+    return context.runLayer(root[job[0]], idIndex, job)
+
+def batchInputs(paths, fileList=None):
+    """expands directories (recursively), glob patterns and a file list (one
+    path per line) into (svg path, path relative to its input root) pairs.
+    The root of a directory is the directory, of a glob pattern the part
+    before the first wildcard, and of the files given by name their common
+    parent directory."""
+    import glob
+    import os
+
+    paths = list(paths)
+    if None != fileList:
+        if '-' == fileList:
+            lines = sys.stdin.read().splitlines()
+        else:
+            fd = open(fileList, 'r')
+            lines = fd.read().splitlines()
+            fd.close()
+        paths.extend(line.strip() for line in lines if line.strip())
+
+    inputs = []
+    files = [] # indices of the files given by name in inputs
+    for path in paths:
+        if os.path.isdir(path):
+            for dirPath, dirNames, fileNames in os.walk(path):
+                dirNames.sort()
+                for fileName in sorted(fileNames):
+                    if fileName.lower().endswith('.svg'):
+                        svgPath = os.path.join(dirPath, fileName)
+                        inputs.append( (svgPath, os.path.relpath(svgPath, path)) )
+        elif os.path.exists(path):
+            files.append(len(inputs))
+            inputs.append( (path, None) )
+        else:
+            root = []
+            for part in path.replace(os.sep, '/').split('/'):
+                if reGlobMagic.search(part):
+                    break
+                root.append(part)
+            root = '/'.join(root) or '.'
+            for svgPath in sorted(glob.glob(path)):
+                inputs.append( (svgPath, os.path.relpath(svgPath, root)) )
+    if len(files) > 0:
+        # commonprefix() compares characters, its parent is a common directory
+        common = os.path.dirname(os.path.commonprefix(
+            [os.path.abspath(inputs[i][0]) for i in files]))
+        for i in files:
+            svgPath = inputs[i][0]
+            inputs[i] = (svgPath, os.path.relpath(os.path.abspath(svgPath), common))
+    return inputs
+
+reGlobMagic = re.compile('[*?[]')
+
+def batchConvertFile(job):
+    """converts one file for batchConvert(), this runs in a worker process.
+    Returns (svg path, eps path, seconds, error message or None, alerts,
+    statistics)"""
+    import os
+    import time
+
+    svgPath, epsPath, options = job
+    start = time.time()
+    converter = svg2eps(svgPath)
+    for name, value in options.items():
+        setattr(converter, name, value)
+    error = None
+    alerts = {}
+    statistics = {}
+    try:
+        epsDir = os.path.dirname(epsPath)
+        if epsDir and not os.path.isdir(epsDir):
+            try:
+                os.makedirs(epsDir)
+            except OSError:
+                # another worker may have created it in the meantime
+                if not os.path.isdir(epsDir):
+                    raise
+        out = open(epsPath, 'w')
+        try:
+            converter.convert(out=out, alerts=alerts, statistics=statistics)
+        finally:
+            out.close()
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        if os.path.exists(epsPath):
+            os.remove(epsPath)
+    return (svgPath, epsPath, time.time() - start, error, alerts, statistics)
+
+def batchConvert(inputs, outputDir=None, jobs=None, options=None):
+    """converts (svg path, relative path) pairs in a process pool of jobs
+    processes (number of CPUs if None). The eps file is written next to the
+    svg file, or to the relative path under outputDir.
+    Returns the list of batchConvertFile() results in input order.
+    Raises ValueError before converting anything if two inputs would be
+    written to the same eps file."""
+    import os
+
+    if None == options:
+        options = {}
+    batch = []
+    targets = {} # normalized eps path -> svg path
+    for svgPath, relPath in inputs:
+        if None == outputDir:
+            epsPath = os.path.splitext(svgPath)[0] + '.eps'
+        else:
+            epsPath = os.path.join(outputDir, os.path.splitext(relPath)[0] + '.eps')
+        target = os.path.normcase(os.path.abspath(epsPath))
+        if target in targets:
+            raise ValueError("%s and %s would both be written to %s" % \
+                (targets[target], svgPath, epsPath))
+        targets[target] = svgPath
+        batch.append( (svgPath, epsPath, options) )
+
+    if 1 == jobs or len(batch) <= 1:
+        return list(map(batchConvertFile, batch))
+
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(batchConvertFile, batch, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def batchSummary(results, out):
+    """writes per-file timings, failures, alerts and simplification counts of
+    batchConvert() to out"""
+    failures = 0
+    totalTime = 0.0
+    for svgPath, epsPath, seconds, error, alerts, statistics in results:
+        totalTime += seconds
+        if None == error:
+            out.write("%8.3fs  %s -> %s\n" % (seconds, svgPath, epsPath))
+        else:
+            failures += 1
+            out.write("%8.3fs  %s FAILED: %s\n" % (seconds, svgPath, error))
+        for string in sorted(alerts):
+            out.write("            %s %s\n" % (string, ', '.join(sorted(alerts[string]))))
+        removedPoints = statistics.get('removedPoints')
+        if removedPoints:
+            out.write("            %d points removed by simplification\n" % sum(removedPoints.values()))
+    out.write("%d files, %d failed, %.3fs total conversion time\n" % \
+        (len(results), failures, totalTime))
+    return failures
+
+def batchMain(args):
+    """command line entry point of the batch converter"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='aieps_output.py --batch',
+        description='Convert many svg files to AI compatible eps in parallel.')
+    parser.add_argument('paths', nargs='*', help='svg files, directories or glob patterns')
+    parser.add_argument('--files-from', metavar='FILE', help='read svg paths from FILE, one per line (- for stdin)')
+    parser.add_argument('-o', '--output-dir', help='write eps files into this directory tree instead of next to the svg files')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--procedures', action='store_true', help='export clones as PostScript procedures (not for Illustrator)')
+    parser.add_argument('--decimals', type=int, help='number of decimals of numbers in the eps (default: 6)')
+    parser.add_argument('--tolerance', type=float, help='set the number of decimals from a rounding tolerance in points')
+    parser.add_argument('--compact', action='store_true', help='drop trailing zeros from numbers')
+    parser.add_argument('--streaming', action='store_true', help='parse the svg files incrementally, for files larger than memory')
+    parser.add_argument('--tight-bbox', action='store_true', help='write the bounding box of the drawing instead of the page size')
+    parser.add_argument('--simplify', type=float, metavar='TOLERANCE', help='simplify paths within TOLERANCE points')
+    parser.add_argument('--cache-dir', help='reuse the converted top level layers cached in this directory')
+    parser.add_argument('--cache-size', type=int, default=256, help='maximum size of the layer cache in megabytes (default: 256)')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the layer cache')
+    options = parser.parse_args(args)
+
+    inputs = batchInputs(options.paths, options.files_from)
+    if len(inputs) == 0:
+        parser.error("no svg files found")
+    converterOptions = {}
+    if options.procedures:
+        converterOptions['useProcedures'] = True
+    if None != options.tolerance:
+        if not options.tolerance > 0:
+            parser.error("--tolerance must be positive")
+        converterOptions['decimals'] = decimalsForTolerance(options.tolerance)
+    if None != options.decimals:
+        converterOptions['decimals'] = options.decimals
+    if options.compact:
+        converterOptions['compactNumbers'] = True
+    if options.streaming:
+        converterOptions['streaming'] = True
+    if options.tight_bbox:
+        converterOptions['tightBoundingBox'] = True
+    if None != options.simplify:
+        converterOptions['simplifyTolerance'] = options.simplify
+    if None != options.cache_dir:
+        converterOptions['cacheDir'] = options.cache_dir
+        converterOptions['cacheMaxSize'] = options.cache_size << 20
+    if options.no_cache:
+        converterOptions['useCache'] = False
+    try:
+        results = batchConvert(inputs, options.output_dir, options.jobs, converterOptions)
+    except ValueError as e:
+        parser.error(str(e))
+    failures = batchSummary(results, sys.stdout)
+    return 1 if failures > 0 else 0
+
+def convertFile(svgPath, out=None, converter=None):
+    """converts the svg file at svgPath, and writes the eps into out (file-like
+    object). If out is None, the eps is returned as a string. converter is an
+    optionally preconfigured svg2eps instance."""
+    if None != converter and converter.streaming:
+        return converter.convert(out=out, filename=svgPath)
+    fd = open(svgPath, 'rb')
+    svg = fd.read()
+    fd.close()
+    return convertBytes(svg, out, converter)
+
+defaultConverter = None # shared svg2eps instance of convertBytes(), created on first use
+
+def convertBytes(svg, out=None, converter=None):
+    """converts svg document data, and writes the eps into out (file-like
+    object). If out is None, the eps is returned as a string. converter is an
+    optionally preconfigured svg2eps instance."""
+    global defaultConverter
+    if None == converter:
+        if None == defaultConverter:
+            defaultConverter = svg2eps()
+        converter = defaultConverter
+    return converter.convert(svg, out)
+
+def main(argv=None):
+    """command line entry point: converts the svg file given as the first
+    argument to eps on stdout, or runs batchMain() after --batch.
+    Returns the exit status."""
+    if None == argv:
+        argv = sys.argv[1:]
+    if len(argv) < 1:
+        print("missing filename")
+        return 1
+
+    if '--batch' == argv[0]:
+        return batchMain(argv[1:])
+
+    converter = svg2eps(argv[0])
+
+    alerts = {}
+    converter.convert(out=sys.stdout, alerts=alerts)
+    #TODO: show alerts in dialogbox
+    #converter.showAlerts(alerts)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())